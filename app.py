@@ -1,74 +1,610 @@
+import atexit
 import os
 import subprocess
 import logging
-from flask import Flask, jsonify, request, send_from_directory, send_file
-from threading import Lock
+import ctypes
+import ctypes.util
+import errno
+import functools
+import fcntl
+import select
+import selectors
+import collections
+import contextlib
+import struct
+import mimetypes
+import re
+import signal
+from multiprocessing import shared_memory
+from urllib.parse import quote
+from flask import Flask, Response, abort, jsonify, request, send_from_directory, send_file
+from werkzeug.security import safe_join
+from threading import Condition, Lock, Thread
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import datetime
 import cv2
+try:
+    import av  # Optional: in-process capture test for debug_camera without OpenCV
+except ImportError:
+    av = None
+import psutil
 from pathlib import Path
 import time
 
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)  # /static is served by serve_static below
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Global dictionary to store active FFmpeg processes for each camera.
-# Structure:
-#   active_ffmpeg_processes = {
-#       "0": { "main": <subprocess.Popen>, "hls": <subprocess.Popen> or None },
-#       "1": { "main": <...>, "hls": <...> },
-#       ...
-#   }
-active_ffmpeg_processes = {}
-process_lock = Lock()  # Ensure thread-safe access to the above dictionary
-
 # Add these constants at the top
 MAX_CAMERAS = 10
 RECORDINGS_DIR = "recordings"
 
+# HLS segments are rewritten every second, so keep them in RAM (tmpfs) rather
+# than on flash. static/hls is a symlink to this directory.
+HLS_ROOT = os.environ.get("HLS_ROOT", "/dev/shm/cammanager/hls")
+STATIC_HLS_DIR = os.path.join("static", "hls")
+
+# Per-camera stream state, stored as parallel arrays indexed by the integer camera
+# id (camera "3" lives in slot 3). Each slot has its own lock, so starting or
+# stopping one camera never waits on another, and readers need no lock at all.
+MAIN_PROCS = [None] * MAX_CAMERAS   # Running FFmpeg process of each camera
+START_TIMES = [None] * MAX_CAMERAS  # time.time() at which each stream came up
+SLOT_LOCKS = [Lock() for _ in range(MAX_CAMERAS)]
+
+def camera_slot(camera_id):
+    """Map a camera id to its slot in the per-camera arrays, raising ValueError if invalid"""
+    try:
+        slot = int(camera_id)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid camera id {camera_id!r}")
+    if not 0 <= slot < MAX_CAMERAS:
+        raise ValueError(f"Camera id must be between 0 and {MAX_CAMERAS - 1}")
+    return slot
+
+SEGMENT_WAIT_TIMEOUT = 10  # Seconds to wait for the first HLS segment of a new stream
+
+# Internal nginx location (e.g. "/protected") that maps to the app directory. When set,
+# file routes reply with X-Accel-Redirect and nginx sends the file itself with sendfile()
+X_ACCEL_PREFIX = os.environ.get("CAMMANAGER_X_ACCEL_PREFIX", "").rstrip("/")
+
+###############################################################################
+# inotify helpers (event-driven tracking of HLS segments)
+###############################################################################
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.inotify_init1.argtypes = [ctypes.c_int]
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (OSError, AttributeError):
+    _libc = None  # Not Linux; fall back to polling the HLS directories
+
+def inotify_init():
+    """Create a non-blocking inotify fd, or return None if inotify is unavailable"""
+    if _libc is None:
+        return None
+    fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        logger.warning(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        return None
+    return fd
+
+def inotify_add_watch(fd, path, mask):
+    """Add a watch on path and return its watch descriptor"""
+    wd = _libc.inotify_add_watch(fd, os.fsencode(path), mask)
+    if wd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    return wd
+
+def inotify_read(fd, timeout):
+    """Return pending (wd, mask, name) events, blocking for at most timeout seconds"""
+    readable, _, _ = select.select([fd], [], [], timeout)
+    if not readable:
+        return []
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return []
+
+    events = []
+    offset = 0
+    while offset < len(data):
+        wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+        offset += _INOTIFY_EVENT.size
+        name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+        offset += length
+        events.append((wd, mask, name))
+    return events
+
+def is_segment_name(name):
+    """Check whether a file name is an HLS segment written by FFmpeg"""
+    return name.startswith("segment") and name.endswith(".ts")
+
+###############################################################################
+# Stream health block, read by the status endpoints without syscalls
+###############################################################################
+
+def create_health_block():
+    """Allocate the shared memory behind the health arrays (plain memory as a fallback)"""
+    size = MAX_CAMERAS * (8 + 4 + 1)
+    try:
+        return shared_memory.SharedMemory(create=True, size=size)
+    except OSError as e:
+        logger.warning(f"Shared memory unavailable ({e}), keeping stream health in process memory")
+        return None
+
+def close_health_block():
+    """Release the health arrays and remove the shared memory block"""
+    for view in (HEALTH_MTIME, HEALTH_SIZE, HEALTH_RUNNING):
+        view.release()
+    _health_shm.close()
+    _health_shm.unlink()
+
+# Per-camera health as parallel arrays over one block: mtime and size of the
+# newest finished segment, and whether FFmpeg is running. The segment watcher
+# and stderr pump threads are the only writers; readers take no locks.
+_health_shm = create_health_block()
+_health_buf = _health_shm.buf if _health_shm else memoryview(bytearray(MAX_CAMERAS * (8 + 4 + 1)))
+HEALTH_MTIME = _health_buf[:8 * MAX_CAMERAS].cast("d")
+HEALTH_SIZE = _health_buf[8 * MAX_CAMERAS:12 * MAX_CAMERAS].cast("I")
+HEALTH_RUNNING = _health_buf[12 * MAX_CAMERAS:13 * MAX_CAMERAS]
+if _health_shm:
+    atexit.register(close_health_block)
+HEALTH_REFRESH_INTERVAL = 1.0  # Seconds between checks of the FFmpeg processes
+
+def publish_segment_health(camera_id):
+    """Copy the newest indexed segment of a camera into the health block"""
+    try:
+        slot = camera_slot(camera_id)
+    except ValueError:
+        return
+    segments = SEGMENT_INDEX.get(camera_id)
+    if segments:
+        _, size, mtime = segments[-1]
+        HEALTH_MTIME[slot] = mtime
+        HEALTH_SIZE[slot] = min(size, 0xFFFFFFFF)
+    else:
+        HEALTH_MTIME[slot] = 0.0
+        HEALTH_SIZE[slot] = 0
+
+def refresh_running_flags():
+    """Poll the tracked FFmpeg processes into the health block"""
+    for slot, process in enumerate(MAIN_PROCS):
+        HEALTH_RUNNING[slot] = process is not None and process.poll() is None
+
+###############################################################################
+# HLS segment index, kept up to date by a single inotify watcher thread
+###############################################################################
+
+SEGMENT_INDEX_SIZE = 32  # Finished segments remembered per camera
+SEGMENT_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM
+
+# camera id -> deque of (name, size, mtime) of finished segments, oldest first
+SEGMENT_INDEX = {}
+_segment_cond = Condition()  # Guards the index; notified whenever a segment is added
+_segment_inotify_fd = inotify_init()
+_segment_watches = {}  # inotify watch descriptor -> camera id
+
+def scan_segments(camera_id):
+    """List (name, size, mtime) of the segments on disk for a camera, oldest first"""
+    hls_directory = hls_camera_directory(camera_id)
+    segments = []
+    try:
+        with os.scandir(hls_directory) as entries:
+            for entry in entries:
+                if not is_segment_name(entry.name):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                segments.append((entry.name, stat.st_size, stat.st_mtime))
+    except FileNotFoundError:
+        return []
+    segments.sort(key=lambda segment: segment[2])
+    return segments
+
+def watch_segments(camera_id):
+    """Start indexing a camera's HLS directory (idempotent; the directory must exist)"""
+    if _segment_inotify_fd is None:
+        return
+    hls_directory = hls_camera_directory(camera_id)
+    wd = inotify_add_watch(_segment_inotify_fd, hls_directory, SEGMENT_EVENTS)
+    with _segment_cond:
+        if _segment_watches.get(wd) != camera_id:
+            _segment_watches[wd] = camera_id
+            # Pick up segments written before the watch existed
+            SEGMENT_INDEX[camera_id] = collections.deque(scan_segments(camera_id), maxlen=SEGMENT_INDEX_SIZE)
+            publish_segment_health(camera_id)
+            _segment_cond.notify_all()
+
+def list_segments(camera_id):
+    """Return (name, size, mtime) of a camera's finished segments, oldest first"""
+    if _segment_inotify_fd is None:
+        return scan_segments(camera_id)
+    with _segment_cond:
+        if camera_id not in SEGMENT_INDEX:
+            hls_directory = hls_camera_directory(camera_id)
+            if not os.path.isdir(hls_directory):
+                return []
+            watch_segments(camera_id)
+        return list(SEGMENT_INDEX[camera_id])
+
+def forget_segments(camera_id):
+    """Drop the indexed segments of a camera whose HLS files were removed"""
+    with _segment_cond:
+        if camera_id in SEGMENT_INDEX:
+            SEGMENT_INDEX[camera_id].clear()
+        publish_segment_health(camera_id)
+
+def update_segment_index(camera_id, mask, name):
+    """Apply one inotify event to the index of a camera (called with _segment_cond held)"""
+    hls_directory = hls_camera_directory(camera_id)
+    path = os.path.join(hls_directory, name)
+    segments = SEGMENT_INDEX.setdefault(camera_id, collections.deque(maxlen=SEGMENT_INDEX_SIZE))
+    entries = [segment for segment in segments if segment[0] != name]
+
+    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        entries.append((name, stat.st_size, stat.st_mtime))
+    elif os.path.exists(path):
+        return  # Stale delete event for a name FFmpeg has already written again
+
+    SEGMENT_INDEX[camera_id] = collections.deque(entries, maxlen=SEGMENT_INDEX_SIZE)
+
+def segment_watcher():
+    """Keep SEGMENT_INDEX in sync with the HLS directories"""
+    while True:
+        events = inotify_read(_segment_inotify_fd, 1.0)
+        if not events:
+            continue
+        with _segment_cond:
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost; rebuild the index from disk
+                    for camera_id in set(_segment_watches.values()):
+                        SEGMENT_INDEX[camera_id] = collections.deque(
+                            scan_segments(camera_id), maxlen=SEGMENT_INDEX_SIZE)
+                        publish_segment_health(camera_id)
+                    continue
+                camera_id = _segment_watches.get(wd)
+                if camera_id is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # The directory was removed
+                    del _segment_watches[wd]
+                    SEGMENT_INDEX.pop(camera_id, None)
+                    publish_segment_health(camera_id)
+                elif is_segment_name(name):
+                    update_segment_index(camera_id, mask, name)
+                    publish_segment_health(camera_id)
+            _segment_cond.notify_all()
+
+def start_segment_watcher():
+    """Index existing camera directories and start the watcher thread"""
+    if _segment_inotify_fd is None:
+        logger.warning("inotify unavailable, HLS segments will be listed from disk")
+        return
+    for entry in Path(HLS_ROOT).glob("camera_*"):
+        if entry.is_dir():
+            watch_segments(entry.name[len("camera_"):])
+    Thread(target=segment_watcher, daemon=True).start()
+
+def wait_for_segments(processes, timeout):
+    """
+    Wait until every camera in processes has finished its first HLS segment.
+
+    Cameras whose FFmpeg process exits are dropped from the wait. Returns the
+    set of ready camera ids.
+    """
+    deadline = time.monotonic() + timeout
+    poll_interval = 0.5 if _segment_inotify_fd is not None else 0.1
+
+    with _segment_cond:
+        while True:
+            ready = {camera_id for camera_id in processes if list_segments(camera_id)}
+            # Stop waiting on cameras whose FFmpeg already died
+            pending = [
+                camera_id for camera_id in processes
+                if camera_id not in ready and processes[camera_id].poll() is None
+            ]
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                return ready
+            _segment_cond.wait(min(remaining, poll_interval))
+
+###############################################################################
+# V4L2 helpers (query devices without opening a capture stream)
+###############################################################################
+
+VIDIOC_QUERYCAP = 0x80685600  # _IOR('V', 0, struct v4l2_capability)
+VIDIOC_ENUM_FMT = 0xC0405602  # _IOWR('V', 2, struct v4l2_fmtdesc)
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+_V4L2_CAPABILITY = struct.Struct("16s32s32sIII12x")
+_V4L2_FMTDESC = struct.Struct("III32sII12x")
+
+def probe_v4l2(camera_id):
+    """
+    Check that /dev/video{camera_id} is a V4L2 capture device using VIDIOC_QUERYCAP.
+    The device is never streamed from, so FFmpeg can open it right after.
+    Raises OSError if the device is missing or unusable.
+    """
+    device_path = f"/dev/video{camera_id}"
+    fd = os.open(device_path, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        buf = bytearray(_V4L2_CAPABILITY.size)
+        fcntl.ioctl(fd, VIDIOC_QUERYCAP, buf)
+    finally:
+        os.close(fd)
+
+    driver, card, bus_info, _, capabilities, device_caps = _V4L2_CAPABILITY.unpack(buf)
+    if capabilities & V4L2_CAP_DEVICE_CAPS:
+        capabilities = device_caps
+    if not capabilities & V4L2_CAP_VIDEO_CAPTURE:
+        raise OSError(errno.ENODEV, "Not a video capture device", device_path)
+
+    return {
+        "driver": driver.rstrip(b"\0").decode(errors="replace"),
+        "card": card.rstrip(b"\0").decode(errors="replace"),
+        "bus_info": bus_info.rstrip(b"\0").decode(errors="replace"),
+        "capabilities": capabilities,
+    }
+
+def list_v4l2_formats(camera_id):
+    """List the capture pixel formats of a camera as lowercase fourccs (e.g. 'mjpg', 'yuyv')"""
+    formats = []
+    fd = os.open(f"/dev/video{camera_id}", os.O_RDWR | os.O_NONBLOCK)
+    try:
+        for index in range(64):
+            buf = bytearray(_V4L2_FMTDESC.pack(index, V4L2_BUF_TYPE_VIDEO_CAPTURE, 0, b"", 0, 0))
+            try:
+                fcntl.ioctl(fd, VIDIOC_ENUM_FMT, buf)
+            except OSError as e:
+                if e.errno == errno.EINVAL:  # End of the format list
+                    break
+                raise
+            pixelformat = _V4L2_FMTDESC.unpack(buf)[4]
+            formats.append(struct.pack("<I", pixelformat).decode("ascii", "replace").strip().lower())
+    finally:
+        os.close(fd)
+    return formats
+
 ###############################################################################
 # Helper functions to build FFmpeg commands
 ###############################################################################
 
-def build_ffmpeg_command(camera_id, outputs):
-    """Build FFmpeg command for reliable streaming"""
-    hls_directory = ensure_hls_directory(camera_id)
-    playlist_path = os.path.join(hls_directory, "playlist.m3u8")
+def ffmpeg_threads_per_invocation(n_cams):
+    """
+    Number of encoder threads each FFmpeg may use so that n_cams concurrent
+    encoders share the CPU instead of each spawning one thread per core.
+    Can be overridden with CAMMANAGER_FFMPEG_THREADS.
+    """
+    override = os.environ.get("CAMMANAGER_FFMPEG_THREADS")
+    if override:
+        return max(1, int(override))
+    return max(1, (os.cpu_count() or 4) // max(1, n_cams))
+
+HW_ENCODERS = ("h264_nvenc", "h264_vaapi", "h264_v4l2m2m", "h264_rkmpp")  # In order of preference
+VAAPI_DEVICE = os.environ.get("CAMMANAGER_VAAPI_DEVICE", "/dev/dri/renderD128")
 
+def encoder_input_args(encoder):
+    """Global FFmpeg options the encoder needs ahead of the input"""
+    if encoder == "h264_vaapi":
+        return ["-vaapi_device", VAAPI_DEVICE]
+    return []
+
+def video_encoder_args(encoder, bitrate, gop, threads, x264_args):
+    """
+    Video encoding options for encoder. x264_args are the libx264 tuning options
+    of the calling command builder and are only used for the software fallback.
+    """
+    if encoder == "h264_nvenc":
+        return [
+            "-c:v", "h264_nvenc",
+            "-preset", "p2",
+            "-tune", "ull",
+            "-profile:v", "baseline",
+            "-rc", "cbr",
+            "-b:v", bitrate,
+            "-g", str(gop),
+        ]
+    if encoder == "h264_vaapi":
+        return [
+            "-vf", "format=nv12,hwupload",
+            "-c:v", "h264_vaapi",
+            "-b:v", bitrate,
+            "-g", str(gop),
+        ]
+    if encoder in ("h264_v4l2m2m", "h264_rkmpp"):
+        return [
+            "-c:v", encoder,
+            "-pix_fmt", "yuv420p",
+            "-b:v", bitrate,
+            "-g", str(gop),
+        ]
     return [
+        "-c:v", "libx264",
+        "-threads", str(threads),
+        "-x264-params", f"threads={threads}:sliced-threads=0",
+        *x264_args,
+    ]
+
+def hw_encoder_works(encoder):
+    """Encode one test frame to check that the encoder has working hardware behind it"""
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        *encoder_input_args(encoder),
+        "-f", "lavfi", "-i", "testsrc=size=640x480:rate=30",
+        "-frames:v", "1",
+        *video_encoder_args(encoder, "1000k", 30, 1, []),
+        "-f", "null", "-"
+    ]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=10).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+@functools.lru_cache(maxsize=None)
+def detect_hw_encoder():
+    """Pick the first working hardware H.264 encoder, falling back to libx264 (probed once)"""
+    override = os.environ.get("CAMMANAGER_ENCODER")
+    if override:
+        return override
+
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            timeout=10
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Could not list FFmpeg encoders: {e}")
+        return "libx264"
+
+    for encoder in HW_ENCODERS:
+        if f" {encoder} " in result.stdout and hw_encoder_works(encoder):
+            logger.info(f"Using hardware encoder {encoder}")
+            return encoder
+
+    logger.info("No hardware encoder available, using libx264")
+    return "libx264"
+
+
+@dataclass(frozen=True)
+class StreamProfile:
+    """Everything that determines a camera's FFmpeg command line except the recording file name"""
+    camera_id: str
+    encoder: str
+    threads: int
+    hls: bool = True
+    record: bool = False
+    width: int = 640
+    height: int = 480
+    fps: int = 30
+    bitrate_kbps: int = 2000
+    gop: int = 30
+
+# Stands in for the recording path in compiled commands; replaced on every start
+RECORDING_PATH_PLACEHOLDER = "{recording_path}"
+
+@functools.lru_cache(maxsize=64)
+def compile_ffmpeg_command(profile):
+    """
+    Build the FFmpeg argv for a profile: capture and encode the camera once and fan
+    the encoded stream out to HLS and/or an MP4 recording through the tee muxer
+    """
+    tee_outputs = []
+    if profile.hls:
+        hls_directory = hls_camera_directory(profile.camera_id)
+        playlist_path = os.path.join(hls_directory, "playlist.m3u8")
+        hls_options = [
+            "f=hls",
+            "hls_time=1",
+            "hls_list_size=3",
+            "hls_flags=delete_segments+append_list",
+            f"hls_segment_filename={hls_directory}/segment%03d.ts",
+        ]
+        if profile.record:
+            # MP4 needs global headers; repeat SPS/PPS in-band so HLS segments stay decodable
+            hls_options.append("bsfs/v=dump_extra")
+        tee_outputs.append(f"[{':'.join(hls_options)}]{playlist_path}")
+    if profile.record:
+        tee_outputs.append(f"[f=mp4:movflags=+faststart]{RECORDING_PATH_PLACEHOLDER}")
+
+    return (
         "ffmpeg",
         "-y",
+        "-filter_threads", "1",
+        "-filter_complex_threads", "1",
+        *encoder_input_args(profile.encoder),
         # Input options
         "-f", "v4l2",
         "-input_format", "mjpeg",  # Try MJPEG first
-        "-video_size", "640x480",
-        "-framerate", "30",
-        "-i", f"/dev/video{camera_id}",
+        "-video_size", f"{profile.width}x{profile.height}",
+        "-framerate", str(profile.fps),
+        # Start emitting frames immediately instead of probing the device for ~5s
+        "-probesize", "32",
+        "-analyzeduration", "0",
+        "-fflags", "nobuffer+genpts+discardcorrupt",
+        "-flags", "low_delay",
+        "-avioflags", "direct",
+        "-i", f"/dev/video{profile.camera_id}",
+        "-map", "0:v",
         
         # Simple encoding options
-        "-c:v", "libx264",
-        "-preset", "ultrafast",
-        "-tune", "zerolatency",
-        "-pix_fmt", "yuv420p",
-        "-g", "30",
-        "-b:v", "2000k",
-        "-bufsize", "4000k",
-        "-maxrate", "2000k",
+        *video_encoder_args(profile.encoder, f"{profile.bitrate_kbps}k", profile.gop, profile.threads, [
+            "-preset", "ultrafast",
+            "-tune", "zerolatency",
+            "-pix_fmt", "yuv420p",
+            "-g", str(profile.gop),
+            "-b:v", f"{profile.bitrate_kbps}k",
+            "-bufsize", f"{2 * profile.bitrate_kbps}k",
+            "-maxrate", f"{profile.bitrate_kbps}k",
+        ]),
+        *(["-flags", "+global_header"] if profile.record else []),
         
-        # HLS options
-        "-f", "hls",
-        "-hls_time", "1",
-        "-hls_list_size", "3",
-        "-hls_flags", "delete_segments+append_list",
-        "-hls_segment_filename", f"{hls_directory}/segment%03d.ts",
-        playlist_path
-    ]
+        # Outputs
+        "-flush_packets", "1",
+        "-f", "tee",
+        "|".join(tee_outputs)
+    )
+
+def build_ffmpeg_command(camera_id, outputs, threads=None):
+    """Return the FFmpeg command for a camera, from the compiled command of its profile"""
+    enable_hls = outputs.get("hls", {}).get("enabled", True)
+    enable_record = outputs.get("recording", {}).get("enabled", False)
+    if not enable_hls and not enable_record:
+        raise ValueError("No outputs enabled")
+
+    profile = StreamProfile(
+        camera_id=str(camera_id),
+        encoder=detect_hw_encoder(),
+        threads=threads or ffmpeg_threads_per_invocation(1),
+        hls=enable_hls,
+        record=enable_record,
+    )
+    if enable_hls:
+        ensure_hls_directory(camera_id)
+    cmd = list(compile_ffmpeg_command(profile))
+
+    if enable_record:
+        os.makedirs(RECORDINGS_DIR, exist_ok=True)
+        filename = f"camera_{camera_id}_{datetime.now().strftime('%Y%m%d-%H%M%S')}.mp4"
+        filepath = os.path.join(RECORDINGS_DIR, filename)
+        cmd[-1] = cmd[-1].replace(RECORDING_PATH_PLACEHOLDER, filepath)
+    return cmd
+
+def hls_camera_directory(camera_id):
+    """Directory FFmpeg writes the HLS playlist and segments of a camera to"""
+    return os.path.join(HLS_ROOT, f"camera_{camera_id}")
+
+_hls_directories = set()  # HLS directories already set up by ensure_hls_directory
 
 def ensure_hls_directory(camera_id):
-    """Ensure HLS directory exists with proper permissions"""
-    hls_directory = os.path.join("static", "hls", f"camera_{camera_id}")
+    """Ensure HLS directory exists with proper permissions (once per directory)"""
+    hls_directory = hls_camera_directory(camera_id)
+    if hls_directory in _hls_directories:
+        return hls_directory
     try:
         # Create directory with parents if it doesn't exist
         Path(hls_directory).mkdir(parents=True, exist_ok=True)
@@ -78,78 +614,12 @@ def ensure_hls_directory(camera_id):
         playlist_path = os.path.join(hls_directory, "playlist.m3u8")
         Path(playlist_path).touch()
         os.chmod(playlist_path, 0o644)
+        _hls_directories.add(hls_directory)
         return hls_directory
     except Exception as e:
         logger.error(f"Failed to create HLS directory: {str(e)}")
         raise
 
-def build_hls_command(camera_id, outputs):
-    """Build the HLS FFmpeg command with ultra-low latency settings"""
-    hls_conf = outputs.get("hls", {})
-    if not hls_conf.get("enabled", False):
-        return None
-
-    hls_directory = ensure_hls_directory(camera_id)
-    playlist_path = os.path.join(hls_directory, "playlist.m3u8")
-
-    return [
-        "ffmpeg",
-        "-y",
-        # Input options - Using MJPEG for better performance
-        "-f", "v4l2",
-        "-input_format", "mjpeg",  # Changed from yuyv422 to mjpeg
-        "-video_size", "640x480",
-        "-framerate", "30",
-        "-thread_queue_size", "512",  # Reduced buffer size
-        "-i", f"/dev/video{camera_id}",
-        # Ultra low-latency encoding options
-        "-c:v", "libx264",
-        "-preset", "ultrafast",
-        "-tune", "zerolatency",
-        "-g", "10",             # Reduced GOP size
-        "-sc_threshold", "0",
-        "-b:v", "800k",        # Slightly reduced bitrate
-        "-maxrate", "800k",
-        "-bufsize", "400k",     # Reduced buffer size
-        "-pix_fmt", "yuv420p",
-        "-profile:v", "baseline",
-        "-level", "3.0",
-        "-fps_mode", "vfr",     # Variable framerate mode
-        # HLS specific options for ultra-low latency
-        "-f", "hls",
-        "-hls_time", "0.2",     # Very short segments
-        "-hls_list_size", "2",  # Keep only 2 segments
-        "-hls_flags", "delete_segments+append_list+omit_endlist+discont_start",
-        "-hls_segment_type", "mpegts",
-        "-hls_start_number_source", "datetime",
-        "-start_number", "1",
-        "-hls_segment_filename", f"{hls_directory}/segment%03d.ts",
-        playlist_path
-    ]
-
-def build_recording_command(camera_id, outputs):
-    """Build command for continuous recording"""
-    rec_conf = outputs.get("recording", {})
-    if not rec_conf.get("enabled", False):
-        return None
-
-    os.makedirs(RECORDINGS_DIR, exist_ok=True)
-    filename = f"camera_{camera_id}_{datetime.now().strftime('%Y%m%d-%H%M%S')}.mp4"
-    filepath = os.path.join(RECORDINGS_DIR, filename)
-
-    return [
-        "ffmpeg",
-        "-y",
-        "-f", "v4l2",
-        "-i", f"/dev/video{camera_id}",
-        "-c:v", "libx264",
-        "-preset", "ultrafast",
-        "-tune", "zerolatency",
-        "-c:a", "aac",  # Missing audio support
-        "-f", "mp4",
-        filepath
-    ]
-
 def verify_camera_access(camera_id):
     """Verify that the camera exists and is accessible"""
     try:
@@ -157,17 +627,11 @@ def verify_camera_access(camera_id):
         if not os.path.exists(device_path):
             return False, f"Camera device {device_path} not found"
             
-        # Try to open the camera with OpenCV
-        cap = cv2.VideoCapture(int(camera_id))
-        if not cap.isOpened():
-            return False, "Failed to open camera with OpenCV"
-            
-        # Try to read a frame
-        ret, frame = cap.read()
-        cap.release()
-        
-        if not ret or frame is None:
-            return False, "Failed to read frame from camera"
+        # Query the device instead of opening a capture stream
+        try:
+            probe_v4l2(camera_id)
+        except OSError as e:
+            return False, f"Failed to query camera: {e}"
             
         logger.info(f"Successfully verified camera {camera_id}")
         return True, "Camera is accessible"
@@ -178,61 +642,119 @@ def verify_camera_access(camera_id):
 def test_camera_capture(camera_id):
     """Test camera capture and determine working format"""
     try:
-        cap = cv2.VideoCapture(int(camera_id))
-        if not cap.isOpened():
-            raise Exception(f"Failed to open camera {camera_id}")
-
-        # Try to set YUYV format
-        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('Y', 'U', 'Y', 'V'))
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-        cap.set(cv2.CAP_PROP_FPS, 30)
-
-        ret, frame = cap.read()
-        if not ret:
-            raise Exception(f"Failed to capture frame from camera {camera_id}")
+        probe_v4l2(camera_id)
+        formats = list_v4l2_formats(camera_id)
+        if not formats:
+            raise Exception(f"Camera {camera_id} reports no capture formats")
 
-        # Get actual format being used
-        format_code = int(cap.get(cv2.CAP_PROP_FOURCC))
-        format_name = "".join([chr((format_code >> 8 * i) & 0xFF) for i in range(4)])
-
-        cap.release()
-        return format_name.lower()
+        # Prefer YUYV, otherwise report the first format the camera offers
+        return "yuyv" if "yuyv" in formats else formats[0]
 
     except Exception as e:
         logger.error(f"Error testing camera {camera_id}: {e}")
         raise
 
+# A single daemon thread drains the stderr pipes of all FFmpeg processes
+_stderr_selector = selectors.DefaultSelector()
+_stderr_partial_lines = {}  # fd -> bytes of an unterminated line
+_stderr_pump_lock = Lock()
+_stderr_pump_thread = None
+
+# FFmpeg messages after which the capture cannot recover, optionally prefixed by
+# "[component @ 0x...]" or "/dev/videoN: ". Other lines mentioning errors (e.g.
+# "error concealment" from the MJPEG decoder) are logged but not fatal.
+FFMPEG_FATAL_RE = re.compile(
+    rb"^(?:\[[^\]]*\]\s*|\S+: )?"
+    rb"(?:Cannot|Failed to open|No such (?:device|file)|Device or resource busy|Invalid data found)"
+)
+FFMPEG_ERROR_RE = re.compile(rb"error", re.IGNORECASE)
+
+def handle_ffmpeg_line(process, camera_id, line):
+    """Log a raw FFmpeg output line (bytes); returns False if the process was killed"""
+    # Only kill the process on critical errors
+    if FFMPEG_FATAL_RE.match(line):
+        logger.error(f"FFmpeg fatal error for camera {camera_id}: {line.decode(errors='replace')}")
+        process.kill()
+        return False
+    if FFMPEG_ERROR_RE.search(line):
+        logger.error(f"FFmpeg error for camera {camera_id}: {line.decode(errors='replace')}")
+    elif logger.isEnabledFor(logging.INFO):
+        logger.info(f"FFmpeg camera {camera_id}: {line.decode(errors='replace')}")
+    return True
+
+def unwatch_ffmpeg_output(process):
+    """Stop pumping the stderr of an FFmpeg process and close the pipe"""
+    try:
+        key = _stderr_selector.unregister(process.stderr)
+    except (KeyError, ValueError):
+        return  # Already unregistered
+    _stderr_partial_lines.pop(key.fd, None)
+    process.stderr.close()
+
+def pump_ffmpeg_output():
+    """
+    Read whatever FFmpeg processes have written to stderr and dispatch it line by
+    line, refreshing the running flags of the health block along the way.
+    """
+    next_refresh = 0.0
+    while True:
+        now = time.monotonic()
+        if now >= next_refresh:
+            refresh_running_flags()
+            next_refresh = now + HEALTH_REFRESH_INTERVAL
+        for key, _ in _stderr_selector.select(timeout=HEALTH_REFRESH_INTERVAL):
+            camera_id, process = key.data
+            try:
+                chunk = os.read(key.fd, 65536)
+            except BlockingIOError:
+                continue
+            except OSError:
+                chunk = b""
+
+            if not chunk:
+                # FFmpeg exited and closed its end of the pipe
+                line = _stderr_partial_lines.pop(key.fd, b"").strip()
+                if line:
+                    handle_ffmpeg_line(process, camera_id, line)
+                unwatch_ffmpeg_output(process)
+                continue
+
+            # Progress updates end in "\r" rather than "\n"
+            lines = (_stderr_partial_lines.pop(key.fd, b"") + chunk.replace(b"\r", b"\n")).split(b"\n")
+            _stderr_partial_lines[key.fd] = lines.pop()
+            for raw_line in lines:
+                line = raw_line.strip()
+                if line and not handle_ffmpeg_line(process, camera_id, line):
+                    unwatch_ffmpeg_output(process)
+                    break
+
 def monitor_ffmpeg_output(process, camera_id):
     """Monitor FFmpeg process output for errors"""
-    def reader():
-        while True:
-            line = process.stderr.readline()
-            if not line:
-                break
-            line = line.strip()
-            if line:
-                logger.info(f"FFmpeg camera {camera_id}: {line}")
-                # Check for critical errors
-                if "Error" in line or "error" in line:
-                    logger.error(f"FFmpeg error for camera {camera_id}: {line}")
-                    # Kill the process on critical error
-                    process.kill()
-                    break
-    
-    from threading import Thread
-    Thread(target=reader, daemon=True).start()
+    os.set_blocking(process.stderr.fileno(), False)
+    _stderr_selector.register(process.stderr, selectors.EVENT_READ, data=(camera_id, process))
+    start_stderr_pump()
+
+def start_stderr_pump():
+    """Start the stderr pump thread if it is not running yet"""
+    global _stderr_pump_thread
+
+    with _stderr_pump_lock:
+        if _stderr_pump_thread is None:
+            _stderr_pump_thread = Thread(target=pump_ffmpeg_output, daemon=True)
+            _stderr_pump_thread.start()
 
 def cleanup_hls_files(camera_id):
     """Clean up HLS files before starting new stream"""
     try:
-        hls_directory = os.path.join("static", "hls", f"camera_{camera_id}")
+        hls_directory = hls_camera_directory(camera_id)
         if os.path.exists(hls_directory):
-            for file in os.listdir(hls_directory):
-                try:
-                    os.remove(os.path.join(hls_directory, file))
-                except Exception as e:
-                    logger.warning(f"Failed to remove file: {e}")
+            with os.scandir(hls_directory) as entries:
+                for entry in entries:
+                    try:
+                        os.unlink(entry.path)
+                    except Exception as e:
+                        logger.warning(f"Failed to remove file: {e}")
+        forget_segments(camera_id)
         
         # Recreate directory
         Path(hls_directory).mkdir(parents=True, exist_ok=True)
@@ -259,8 +781,9 @@ def release_camera(camera_id):
     except Exception as e:
         logger.warning(f"Error while trying to release camera {camera_id}: {e}")
 
+@functools.lru_cache(maxsize=None)
 def get_camera_capabilities(camera_id):
-    """Get camera capabilities using v4l2-ctl"""
+    """Get camera capabilities using v4l2-ctl (cached, they do not change while the device is plugged in)"""
     try:
         result = subprocess.run(
             ['v4l2-ctl', '--device', f'/dev/video{camera_id}', '--list-formats-ext'],
@@ -295,19 +818,17 @@ def ensure_camera_format(camera_id):
 def cleanup_old_segments(camera_id):
     """Clean up old HLS segments to prevent disk space issues"""
     try:
-        hls_directory = os.path.join("static", "hls", f"camera_{camera_id}")
-        if os.path.exists(hls_directory):
-            # Get all .ts files
-            segments = sorted(Path(hls_directory).glob("segment*.ts"))
-            
-            # Keep only the latest 10 segments
-            segments_to_delete = segments[:-10] if len(segments) > 10 else []
-            
-            for segment in segments_to_delete:
-                try:
-                    os.remove(segment)
-                except Exception as e:
-                    logger.warning(f"Failed to remove old segment {segment}: {e}")
+        hls_directory = hls_camera_directory(camera_id)
+        segments = list_segments(camera_id)
+        
+        # Keep only the latest 10 segments
+        segments_to_delete = segments[:-10] if len(segments) > 10 else []
+        
+        for name, _, _ in segments_to_delete:
+            try:
+                os.remove(os.path.join(hls_directory, name))
+            except Exception as e:
+                logger.warning(f"Failed to remove old segment {name}: {e}")
                     
     except Exception as e:
         logger.error(f"Error cleaning up segments for camera {camera_id}: {e}")
@@ -315,29 +836,24 @@ def cleanup_old_segments(camera_id):
 def is_camera_available(camera_id):
     """Check if the camera is available and not in use"""
     try:
-        device_path = f"/dev/video{camera_id}"
-        cap = cv2.VideoCapture(camera_id)
-        if cap.isOpened():
-            cap.release()
-            return True
-        return False
-    except Exception as e:
+        probe_v4l2(camera_id)
+        return True
+    except OSError as e:
         logger.error(f"Error checking camera {camera_id}: {e}")
         return False
 
 def verify_video_segments(camera_id):
     """Verify that video segments are being created with valid content"""
     try:
-        hls_directory = os.path.join("static", "hls", f"camera_{camera_id}")
-        segments = list(Path(hls_directory).glob("segment*.ts"))
+        hls_directory = hls_camera_directory(camera_id)
+        segments = list_segments(camera_id)
         
         if not segments:
             logger.error(f"No segments found in {hls_directory}")
             return False
             
         # Check the size of the latest segment
-        latest_segment = max(segments, key=lambda p: p.stat().st_mtime)
-        size = latest_segment.stat().st_size
+        latest_segment, size, _ = max(segments, key=lambda segment: segment[2])
         
         if size < 1000:  # Less than 1KB is probably invalid
             logger.error(f"Latest segment {latest_segment} is too small: {size} bytes")
@@ -350,8 +866,49 @@ def verify_video_segments(camera_id):
         logger.error(f"Error verifying segments: {e}")
         return False
 
+def signal_process(process, sig):
+    """Send sig to the process group of an FFmpeg process (or to the process alone)"""
+    if process.poll() is not None:
+        return  # Already reaped; its pid may belong to someone else by now
+    try:
+        pgid = os.getpgid(process.pid)
+        # FFmpeg leads its own session; never signal the group we are part of
+        if pgid == process.pid and pgid != os.getpgrp():
+            os.killpg(pgid, sig)
+        else:
+            os.kill(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+def terminate_processes(processes, timeout=5):
+    """
+    Terminate FFmpeg processes together: SIGTERM them all, wait up to timeout
+    seconds in total, then SIGKILL whichever are still running.
+    """
+    running = [process for process in processes if process.poll() is None]
+    for process in running:
+        signal_process(process, signal.SIGTERM)
+
+    deadline = time.monotonic() + timeout
+    stuck = []
+    for process in running:
+        try:
+            process.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            stuck.append(process)
+
+    for process in stuck:
+        signal_process(process, signal.SIGKILL)
+    for process in stuck:
+        process.wait()
+
+def terminate_process(process, timeout=5):
+    """Terminate an FFmpeg process, escalating to SIGKILL after timeout seconds"""
+    terminate_processes([process], timeout)
+
+@functools.lru_cache(maxsize=None)
 def get_camera_format(camera_id):
-    """Get supported formats for the camera"""
+    """Get supported formats for the camera (cached)"""
     try:
         result = subprocess.run(
             ['v4l2-ctl', '--device', f'/dev/video{camera_id}', '--list-formats'],
@@ -363,6 +920,257 @@ def get_camera_format(camera_id):
     except:
         return "yuyv422"  # Default to YUYV if can't determine
 
+###############################################################################
+# Stream ownership (pidfiles, spawn lock, adoption)
+###############################################################################
+
+# Pidfiles of running FFmpeg processes, so a restarted app (or another worker)
+# can adopt them instead of spawning a second FFmpeg on the same device
+PID_DIR = os.environ.get("CAMMANAGER_PID_DIR", "/run/cammanager")
+
+def pid_directory():
+    """Return the pidfile directory, falling back to a local one if PID_DIR is not writable"""
+    global PID_DIR
+    try:
+        os.makedirs(PID_DIR, exist_ok=True)
+    except OSError as e:
+        fallback = os.path.abspath("run")
+        logger.warning(f"Cannot use pid directory {PID_DIR} ({e}), using {fallback}")
+        os.makedirs(fallback, exist_ok=True)
+        PID_DIR = fallback
+    return PID_DIR
+
+def pidfile_path(camera_id):
+    return os.path.join(pid_directory(), f"camera_{camera_id}.pid")
+
+def write_pidfile(camera_id, pid):
+    """Atomically record the FFmpeg pid of a camera"""
+    path = pidfile_path(camera_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(f"{pid}\n")
+    os.rename(tmp_path, path)
+
+def read_pidfile(camera_id):
+    try:
+        with open(pidfile_path(camera_id)) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def remove_pidfile(camera_id, pid=None):
+    """Remove the pidfile of a camera, only if it still names pid when given"""
+    if pid is not None and read_pidfile(camera_id) != pid:
+        return
+    try:
+        os.remove(pidfile_path(camera_id))
+    except FileNotFoundError:
+        pass
+
+@contextlib.contextmanager
+def spawn_lock(camera_id):
+    """
+    Hold an exclusive flock for camera_id while checking for and spawning its
+    FFmpeg, serializing concurrent starts across threads and worker processes.
+    """
+    path = os.path.join(pid_directory(), f"camera_{camera_id}.lock")
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def is_camera_ffmpeg(cmdline, camera_id):
+    """Whether cmdline is an FFmpeg capturing /dev/video<camera_id>"""
+    return (
+        bool(cmdline)
+        and os.path.basename(cmdline[0]).startswith("ffmpeg")
+        and f"/dev/video{camera_id}" in cmdline
+    )
+
+def _find_existing_ffmpeg(camera_id):
+    """Return a psutil.Process for a live FFmpeg capturing the camera, or None"""
+    pid = read_pidfile(camera_id)
+    if pid is not None:
+        try:
+            process = psutil.Process(pid)
+            if process.status() != psutil.STATUS_ZOMBIE and is_camera_ffmpeg(process.cmdline(), camera_id):
+                return process
+        except psutil.Error:
+            pass
+
+    for process in psutil.process_iter(["cmdline"]):
+        try:
+            if is_camera_ffmpeg(process.info["cmdline"], camera_id) and process.status() != psutil.STATUS_ZOMBIE:
+                return process
+        except psutil.Error:
+            continue
+    return None
+
+class AdoptedProcess:
+    """Popen-like handle for an FFmpeg process that this app did not spawn"""
+
+    stderr = None  # Its output goes to whoever started it
+
+    def __init__(self, process):
+        self._process = process
+        self.pid = process.pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                if self._process.status() == psutil.STATUS_ZOMBIE:
+                    self.returncode = -1
+            except psutil.NoSuchProcess:
+                self.returncode = -1
+        return self.returncode
+
+    def terminate(self):
+        try:
+            self._process.terminate()
+        except psutil.NoSuchProcess:
+            pass
+
+    def kill(self):
+        try:
+            self._process.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+    def wait(self, timeout=None):
+        try:
+            self._process.wait(timeout)
+        except psutil.TimeoutExpired:
+            raise subprocess.TimeoutExpired(self._process.name(), timeout)
+        if self.returncode is None:
+            self.returncode = -1
+        return self.returncode
+
+def is_stream_running(camera_id):
+    """Whether the tracked FFmpeg of a camera is alive"""
+    process = MAIN_PROCS[camera_slot(camera_id)]
+    return process is not None and process.poll() is None
+
+def adopt_running_streams():
+    """Take over FFmpeg processes left running by a previous instance of the app"""
+    for slot in range(MAX_CAMERAS):
+        camera_id = str(slot)
+        if read_pidfile(camera_id) is None:
+            continue
+        existing = _find_existing_ffmpeg(camera_id)
+        if existing is None:
+            remove_pidfile(camera_id)
+            continue
+        watch_segments(camera_id)
+        with SLOT_LOCKS[slot]:
+            if MAIN_PROCS[slot] is None:
+                MAIN_PROCS[slot] = AdoptedProcess(existing)
+                START_TIMES[slot] = existing.create_time()
+                HEALTH_RUNNING[slot] = True
+        logger.info(f"Adopted running FFmpeg {existing.pid} for camera {camera_id}")
+
+def start_camera(camera_id, threads):
+    """
+    Prepare a camera and spawn its FFmpeg process using threads encoder threads.
+
+    Returns (camera_id, process_or_exception, adopted), where adopted is True
+    when an FFmpeg already capturing the camera was found instead.
+    """
+    try:
+        with spawn_lock(camera_id):
+            existing = _find_existing_ffmpeg(camera_id)
+            if existing is not None:
+                logger.info(f"Camera {camera_id} already has FFmpeg {existing.pid} running")
+                return camera_id, AdoptedProcess(existing), True
+
+            logger.info(f"Starting camera {camera_id}")
+            
+            # Force cleanup
+            cleanup_hls_files(camera_id)
+            
+            # Test camera access without grabbing the device from FFmpeg
+            try:
+                probe_v4l2(camera_id)
+            except OSError as e:
+                raise Exception(f"Failed to open camera {camera_id}: {e}")
+            
+            # Start FFmpeg process
+            cmd = build_ffmpeg_command(camera_id, {}, threads)
+            logger.info(f"Starting FFmpeg: {' '.join(cmd)}")
+            
+            # Index segments from before FFmpeg can write anything
+            watch_segments(camera_id)
+            
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.DEVNULL,  # FFmpeg writes nothing useful there; no pipe to fill up
+                stderr=subprocess.PIPE,  # Raw bytes, split and decoded by the stderr pump
+                bufsize=0,
+                # Our own fds are non-inheritable (PEP 446), so nothing leaks without close_fds,
+                # and the child skips closing every fd up to RLIMIT_NOFILE. It is also one of
+                # the conditions for posix_spawn, though start_new_session still needs fork+exec.
+                close_fds=False,
+                start_new_session=True  # Own process group, so stops can signal FFmpeg as a unit
+            )
+            write_pidfile(camera_id, process.pid)
+        
+        # Monitor FFmpeg output
+        monitor_ffmpeg_output(process, camera_id)
+        return camera_id, process, False
+        
+    except Exception as e:
+        return camera_id, e, False
+
+def stop_cameras(camera_ids=None):
+    """
+    Stop the FFmpeg processes of the given cameras (all cameras when None) and
+    clean up their HLS output. Returns (stopped, errors).
+    """
+    stopped = []
+    errors = {}
+
+    if camera_ids is None:
+        camera_ids = [str(slot) for slot, process in enumerate(MAIN_PROCS) if process is not None]
+
+    entries = {}
+    for camera_id in camera_ids:
+        try:
+            slot = camera_slot(camera_id)
+        except ValueError as e:
+            errors[camera_id] = str(e)
+            continue
+        with SLOT_LOCKS[slot]:
+            process = MAIN_PROCS[slot]
+            MAIN_PROCS[slot] = None
+            START_TIMES[slot] = None
+            HEALTH_RUNNING[slot] = False
+        if process is not None:
+            entries[camera_id] = process
+
+    # Stop all processes at once, sharing a single timeout
+    terminate_processes(entries.values())
+
+    for camera_id, process in entries.items():
+        try:
+            unwatch_ffmpeg_output(process)
+            remove_pidfile(camera_id, process.pid)
+            
+            # Force release camera
+            release_camera(camera_id)
+            
+            # Cleanup HLS files
+            cleanup_hls_files(camera_id)
+            
+            stopped.append(camera_id)
+            
+        except Exception as e:
+            logger.error(f"Error stopping stream for camera {camera_id}: {e}")
+            errors[camera_id] = str(e)
+
+    return stopped, errors
+
 ###############################################################################
 # API endpoints
 ###############################################################################
@@ -380,70 +1188,90 @@ def start_streams():
         
         if not cameras:
             return jsonify({"error": "No cameras specified"}), 400
-            
-        with process_lock:
-            for camera_id in cameras:
-                try:
-                    camera_id = str(camera_id)
-                    logger.info(f"Starting camera {camera_id}")
-                    
-                    # Stop any existing streams
-                    if camera_id in active_ffmpeg_processes:
-                        stop_streams([camera_id])
-                    
-                    # Force cleanup
-                    cleanup_hls_files(camera_id)
-                    release_camera(camera_id)
-                    
-                    # Test camera access
-                    cap = cv2.VideoCapture(int(camera_id))
-                    if not cap.isOpened():
-                        raise Exception(f"Failed to open camera {camera_id}")
-                    cap.release()
-                    
-                    # Start FFmpeg process
-                    cmd = build_ffmpeg_command(camera_id, {})
-                    logger.info(f"Starting FFmpeg: {' '.join(cmd)}")
-                    
-                    process = subprocess.Popen(
-                        cmd,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        universal_newlines=True
-                    )
-                    
-                    # Monitor FFmpeg output
-                    monitor_ffmpeg_output(process, camera_id)
-                    
-                    # Wait for initial segments
-                    time.sleep(3)
-                    
-                    # Check if process is still running
-                    if process.poll() is not None:
-                        raise Exception("FFmpeg process failed to start")
-                    
-                    # Check for segments
-                    hls_directory = os.path.join("static", "hls", f"camera_{camera_id}")
-                    segments = list(Path(hls_directory).glob("segment*.ts"))
-                    if not segments:
-                        raise Exception("No video segments created")
-                    
-                    active_ffmpeg_processes[camera_id] = {"main": process}
-                    started.append(camera_id)
-                    logger.info(f"Successfully started camera {camera_id}")
-                    
-                except Exception as e:
-                    error_msg = f"Error starting camera {camera_id}: {str(e)}"
+        
+        valid_cameras = []
+        for camera_id in dict.fromkeys(str(camera_id) for camera_id in cameras):
+            try:
+                camera_slot(camera_id)
+                valid_cameras.append(camera_id)
+            except ValueError as e:
+                errors[camera_id] = f"Error starting camera {camera_id}: {str(e)}"
+        cameras = valid_cameras
+        
+        # Leave healthy streams alone, and clean up the ones whose FFmpeg died
+        already_running = [camera_id for camera_id in cameras if is_stream_running(camera_id)]
+        cameras = [camera_id for camera_id in cameras if camera_id not in already_running]
+        dead = [camera_id for camera_id in cameras if MAIN_PROCS[camera_slot(camera_id)] is not None]
+        if dead:
+            stop_cameras(dead)
+        
+        # Split the CPU between the streams that will be running
+        running = sum(process is not None for process in MAIN_PROCS)
+        threads = ffmpeg_threads_per_invocation(running + len(cameras))
+        
+        spawned = {}  # camera id -> FFmpeg process awaiting its first segment
+
+        # Probe and spawn all cameras concurrently
+        with ThreadPoolExecutor(max_workers=MAX_CAMERAS) as pool:
+            futures = [pool.submit(start_camera, camera_id, threads) for camera_id in cameras]
+            for future in as_completed(futures):
+                camera_id, result, adopted = future.result()
+                if isinstance(result, Exception):
+                    error_msg = f"Error starting camera {camera_id}: {str(result)}"
                     logger.error(error_msg)
                     errors[camera_id] = error_msg
-                    
-                    # Cleanup on error
-                    if camera_id in active_ffmpeg_processes:
-                        stop_streams([camera_id])
+                    continue
+                if adopted:
+                    # Started by a concurrent request or another worker
+                    slot = camera_slot(camera_id)
+                    with SLOT_LOCKS[slot]:
+                        if MAIN_PROCS[slot] is None:
+                            MAIN_PROCS[slot] = result
+                            START_TIMES[slot] = time.time()
+                            HEALTH_RUNNING[slot] = True
+                    watch_segments(camera_id)
+                    already_running.append(camera_id)
+                    continue
+                spawned[camera_id] = result
+        
+        # Wait for initial segments from all cameras at once
+        ready = wait_for_segments(spawned, SEGMENT_WAIT_TIMEOUT)
+        
+        failed = {}  # camera id -> FFmpeg process to clean up
+        for camera_id, process in spawned.items():
+            if process.poll() is not None:
+                error_msg = f"Error starting camera {camera_id}: FFmpeg process failed to start"
+            elif camera_id not in ready:
+                error_msg = f"Error starting camera {camera_id}: No video segments created"
+            else:
+                slot = camera_slot(camera_id)
+                with SLOT_LOCKS[slot]:
+                    previous = MAIN_PROCS[slot]
+                    MAIN_PROCS[slot] = process
+                    START_TIMES[slot] = time.time()
+                    HEALTH_RUNNING[slot] = True
+                if previous is not None and previous.pid != process.pid:
+                    # A concurrent request adopted this camera in the meantime
+                    terminate_process(previous)
+                    unwatch_ffmpeg_output(previous)
+                started.append(camera_id)
+                logger.info(f"Successfully started camera {camera_id}")
+                continue
+            
+            logger.error(error_msg)
+            errors[camera_id] = error_msg
+            failed[camera_id] = process
+        
+        # Cleanup on error
+        terminate_processes(failed.values())
+        for camera_id, process in failed.items():
+            unwatch_ffmpeg_output(process)
+            remove_pidfile(camera_id, process.pid)
         
         return jsonify({
-            "status": "success" if started else "error",
+            "status": "success" if started or already_running else "error",
             "started": started,
+            "already_running": already_running,
             "errors": errors
         })
         
@@ -454,35 +1282,10 @@ def start_streams():
 
 @app.route('/api/stop-streams', methods=['POST'])
 def stop_streams():
-    """Stop all active FFmpeg processes and cleanup"""
-    stopped = []
-    errors = {}
-
-    with process_lock:
-        for camera_id, procs in list(active_ffmpeg_processes.items()):
-            try:
-                # Stop processes
-                for proc_type, proc in procs.items():
-                    if proc:
-                        proc.terminate()
-                        try:
-                            proc.wait(timeout=5)
-                        except subprocess.TimeoutExpired:
-                            proc.kill()
-                            proc.wait()
-                
-                # Force release camera
-                release_camera(camera_id)
-                
-                # Cleanup HLS files
-                cleanup_hls_files(camera_id)
-                
-                stopped.append(camera_id)
-                del active_ffmpeg_processes[camera_id]
-                
-            except Exception as e:
-                logger.error(f"Error stopping stream for camera {camera_id}: {e}")
-                errors[camera_id] = str(e)
+    """Stop active FFmpeg processes (all, or only the requested cameras) and cleanup"""
+    data = request.get_json(silent=True) or {}
+    cameras = data.get("cameras")
+    stopped, errors = stop_cameras([str(camera_id) for camera_id in cameras] if cameras else None)
 
     return jsonify({
         "status": "success" if not errors else "partial_success",
@@ -494,23 +1297,43 @@ def stop_streams():
 def status():
     """
     Return the status of active streams. For each camera, indicate whether the main FFmpeg
-    process is running.
+    process is running and when its newest segment was written. Served from the health block.
     """
-    status_info = {}
-    with process_lock:
-        for camera_id, procs in active_ffmpeg_processes.items():
-            main_running = procs.get("main") and (procs.get("main").poll() is None)
-            status_info[camera_id] = {"main": main_running}
+    status_info = {
+        str(slot): {
+            "main": bool(HEALTH_RUNNING[slot]),
+            "last_segment_mtime": HEALTH_MTIME[slot],
+            "last_segment_size": HEALTH_SIZE[slot],
+        }
+        for slot, process in enumerate(MAIN_PROCS)
+        if process is not None
+    }
     return jsonify({"active_streams": status_info}), 200
 
+def send_static_file(directory, filename):
+    """
+    Serve a file from directory. Behind nginx the transfer is handed off with
+    X-Accel-Redirect; otherwise Werkzeug passes the open file to the server's
+    wsgi.file_wrapper, which gunicorn implements with sendfile().
+    """
+    if not X_ACCEL_PREFIX:
+        return send_from_directory(directory, filename)
+
+    if safe_join(directory, filename) is None:
+        abort(404)
+    response = Response()
+    response.headers["X-Accel-Redirect"] = quote(f"{X_ACCEL_PREFIX}/{directory}/{filename}")
+    response.headers["Content-Type"] = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    return response
+
 # Add static file serving for HLS and recordings
 @app.route('/hls/<path:filename>')
 def serve_hls(filename):
-    return send_from_directory("hls", filename)
+    return send_static_file("hls", filename)
 
 @app.route('/recordings/<path:filename>')
 def serve_recording(filename):
-    return send_from_directory(RECORDINGS_DIR, filename)
+    return send_static_file(RECORDINGS_DIR, filename)
 
 @app.route('/')
 def admin_interface():
@@ -520,15 +1343,50 @@ def admin_interface():
 def list_recordings():
     files = []
     try:
-        files = os.listdir(RECORDINGS_DIR)
+        with os.scandir(RECORDINGS_DIR) as entries:
+            files = [entry.name for entry in entries if entry.is_file()]
     except Exception as e:
         logger.error(f"Error listing recordings: {str(e)}")
     return jsonify({"recordings": files})
 
+def debug_camera_pyav(camera_id):
+    """Open the camera with PyAV, decode one frame and report its properties"""
+    try:
+        container = av.open(f"/dev/video{camera_id}", format="v4l2",
+                            options={"video_size": "640x480", "framerate": "30"})
+    except av.FFmpegError as e:
+        return jsonify({"error": f"Could not open camera {camera_id}: {e}"}), 400
+
+    with container:
+        stream = container.streams.video[0]
+        props = {
+            "width": stream.codec_context.width,
+            "height": stream.codec_context.height,
+            "fps": float(stream.average_rate or 0),
+            "format": stream.codec_context.name,
+            "backend": "pyav",
+        }
+        try:
+            frame = next(container.decode(stream), None)
+        except av.FFmpegError:
+            frame = None
+
+    if frame is None:
+        return jsonify({"error": "Could not read frame", "properties": props}), 400
+
+    props["pix_fmt"] = frame.format.name
+    return jsonify({
+        "status": "Camera accessible",
+        "properties": props
+    })
+
 @app.route('/api/debug/camera/<camera_id>', methods=['GET'])
 def debug_camera(camera_id):
     """Debug endpoint to check camera status"""
     try:
+        if av is not None:
+            return debug_camera_pyav(camera_id)
+
         cap = cv2.VideoCapture(int(camera_id))
         if not cap.isOpened():
             return jsonify({"error": f"Could not open camera {camera_id}"}), 400
@@ -558,13 +1416,13 @@ def debug_camera(camera_id):
 @app.route('/static/<path:path>')
 def serve_static(path):
     """Serve static files including HLS streams"""
-    return send_from_directory('static', path)
+    return send_static_file('static', path)
 
 @app.route('/api/check-stream/<camera_id>')
 def check_stream(camera_id):
     """Check if stream is working properly"""
     try:
-        hls_directory = os.path.join("static", "hls", f"camera_{camera_id}")
+        hls_directory = hls_camera_directory(camera_id)
         playlist_path = os.path.join(hls_directory, "playlist.m3u8")
         
         if not os.path.exists(playlist_path):
@@ -575,23 +1433,20 @@ def check_stream(camera_id):
             playlist = f.read()
             
         # Get segment info
-        segments = list(Path(hls_directory).glob("segment*.ts"))
         segment_info = [{
-            "name": s.name,
-            "size": s.stat().st_size,
-            "mtime": s.stat().st_mtime
-        } for s in segments]
+            "name": name,
+            "size": size,
+            "mtime": mtime
+        } for name, size, mtime in list_segments(camera_id)]
         
         # Check FFmpeg process
         process_info = None
-        with process_lock:
-            if camera_id in active_ffmpeg_processes:
-                process = active_ffmpeg_processes[camera_id].get("main")
-                if process:
-                    process_info = {
-                        "pid": process.pid,
-                        "returncode": process.poll()
-                    }
+        process = MAIN_PROCS[camera_slot(camera_id)]
+        if process is not None:
+            process_info = {
+                "pid": process.pid,
+                "returncode": process.poll()
+            }
         
         return jsonify({
             "status": "ok",
@@ -612,21 +1467,67 @@ def not_found(e):
 # Run the Flask application
 ###############################################################################
 
+def ensure_hls_root():
+    """Create HLS_ROOT and point static/hls at it, so /static/hls keeps serving it"""
+    global HLS_ROOT
+    try:
+        Path(HLS_ROOT).mkdir(parents=True, exist_ok=True)
+        os.chmod(HLS_ROOT, 0o755)
+    except OSError as e:
+        logger.warning(f"Cannot use HLS root {HLS_ROOT} ({e}), writing segments to {STATIC_HLS_DIR}")
+        HLS_ROOT = STATIC_HLS_DIR
+    if os.path.realpath(HLS_ROOT) == os.path.realpath(STATIC_HLS_DIR):
+        Path(STATIC_HLS_DIR).mkdir(parents=True, exist_ok=True)
+        return
+
+    if os.path.islink(STATIC_HLS_DIR):
+        if os.readlink(STATIC_HLS_DIR) == HLS_ROOT:
+            return
+        os.remove(STATIC_HLS_DIR)
+    elif os.path.isdir(STATIC_HLS_DIR):
+        # Segments left on disk by older versions; set them aside rather than deleting anything on import
+        try:
+            os.rmdir(STATIC_HLS_DIR)
+        except OSError:
+            aside = f"{STATIC_HLS_DIR}.old"
+            if os.path.lexists(aside):
+                logger.error(f"{STATIC_HLS_DIR} is a directory and {aside} exists, serving HLS from {STATIC_HLS_DIR}")
+                HLS_ROOT = STATIC_HLS_DIR
+                return
+            os.rename(STATIC_HLS_DIR, aside)
+            logger.warning(f"Moved existing {STATIC_HLS_DIR} to {aside}")
+    os.symlink(HLS_ROOT, STATIC_HLS_DIR)
+
 def ensure_directories():
     """Ensure all required directories exist"""
     dirs = [
-        "static/hls",
+        "static",
         "recordings",
         "logs"
     ]
     for d in dirs:
         Path(d).mkdir(parents=True, exist_ok=True)
         os.chmod(d, 0o755)
+    ensure_hls_root()
+
+def warmup_probes():
+    """Fill the encoder and camera probe caches before the first start request needs them"""
+    detect_hw_encoder()
+    for slot in range(MAX_CAMERAS):
+        camera_id = str(slot)
+        if os.path.exists(f"/dev/video{camera_id}"):
+            get_camera_format(camera_id)
+            get_camera_capabilities(camera_id)
 
 # Call this when the app starts
 ensure_directories()
+start_segment_watcher()
+adopt_running_streams()
+start_stderr_pump()
+Thread(target=warmup_probes, daemon=True).start()
 
 if __name__ == '__main__':
+    # Development server; in production run gunicorn -c gunicorn.conf.py wsgi:application
     # Create static and recordings directories if they don't exist
     os.makedirs('static', exist_ok=True)
     os.makedirs(RECORDINGS_DIR, exist_ok=True)
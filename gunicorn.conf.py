@@ -0,0 +1,10 @@
+# gunicorn -c gunicorn.conf.py wsgi:application
+#
+# A single worker owns every FFmpeg process (more workers would each track their
+# own streams); its threads keep segment and playlist requests flowing while a
+# start-streams call waits for cameras to come up.
+bind = "0.0.0.0:5000"
+workers = 1
+worker_class = "gthread"
+threads = 32
+timeout = 120
@@ -1,17 +1,61 @@
 import os
 import subprocess
 import logging
-from flask import Flask, jsonify, request, send_from_directory, send_file
+import errno
+import functools
+import fcntl
+import struct
+import heapq
+import selectors
+import shutil
+import hashlib
+import queue
+import glob
+from urllib.parse import quote
+from flask import Flask, Response, jsonify, request, send_from_directory, send_file
+from flask.json.provider import DefaultJSONProvider
 from threading import Lock
-from datetime import datetime
 import threading
+from collections import OrderedDict, defaultdict
+from contextlib import ExitStack
 import cv2
+import numpy as np  # Already required by cv2
+try:
+    import av  # Optional: in-process thumbnail decoding
+    import PIL.features  # VideoFrame.to_image() needs Pillow; features says whether it can write WebP
+except ImportError:
+    av = None
+try:
+    import orjson  # Optional: faster JSON for the polled API responses
+except ImportError:
+    orjson = None
 from pathlib import Path
 import time
 import psutil
 import math
 
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify() through orjson; anything orjson can't encode goes to Flask's default"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Send orjson's bytes as-is instead of round-tripping them through str
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+# Behind Apache mod_xsendfile or lighttpd, let the front server send files itself
+app.config["USE_X_SENDFILE"] = os.environ.get("CAMMANAGER_X_SENDFILE") == "1"
+# Internal nginx location (e.g. "/protected") mapped to the app directory. When set,
+# thumbnails are answered with X-Accel-Redirect and nginx sends the file itself
+X_ACCEL_PREFIX = os.environ.get("CAMMANAGER_X_ACCEL_PREFIX", "").rstrip("/")
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -24,93 +68,337 @@ logger = logging.getLogger(__name__)
 #       "1": { "main": <...>, "hls": <...> },
 #       ...
 #   }
+# Entries are only ever added or removed whole, so readers can take a
+# list(active_ffmpeg_processes.items()) snapshot without locking.
 active_ffmpeg_processes = {}
-process_lock = Lock()  # Ensure thread-safe access to the above dictionary
+# One lock per camera serializes starting and stopping that camera only;
+# status polls and other cameras never wait on it.
+camera_locks = defaultdict(Lock)
 
 # Add these constants at the top
 MAX_CAMERAS = 10
 RECORDINGS_DIR = "recordings"
+THUMBNAILS_DIR = "static/thumbs"
+THUMBNAIL_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Trimmed to this, least recently used first
+THUMBNAIL_SWEEP_INTERVAL = 60  # Seconds between trims of the thumbnail cache
+THUMBNAIL_TIMESTAMP = 1.0  # Seconds into the recording, unless the request asks for another
+THUMBNAIL_TIMEOUT = 30  # Seconds a request waits for the thumbnail worker
+THUMBNAIL_FFMPEG_TIMEOUT = 20  # Seconds before a stuck thumbnail FFmpeg is killed, freeing its worker
+# A recording's frames never change once written (an MP4 can't be decoded before
+# it is finished), so a thumbnail URL may be cached for good
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600  # For URLs carrying the thumbnail_key as ?v=
+THUMBNAIL_REVALIDATE_AGE = 60  # For unversioned URLs, revalidated with the ETag afterwards
+THUMBNAIL_MEMORY_CACHE_BYTES = 64 * 1024 * 1024  # Most recently served thumbnails kept in RAM
+THUMBNAIL_ERROR_TTL = 60  # Seconds a thumbnail that failed is answered with 500 without retrying
+THUMBNAIL_EVENTS_KEEPALIVE = 15  # Seconds between keep-alive comments on the events stream
+# Each events stream holds a server thread (gunicorn.conf.py has 32), so only a
+# few may be open at once, and each is ended after a while for EventSource to reconnect
+THUMBNAIL_EVENTS_MAX_SUBSCRIBERS = 8
+THUMBNAIL_EVENTS_LIFETIME = 300  # Seconds
+THUMBNAIL_EVENTS_RETRY = 3000  # Milliseconds EventSource waits before reconnecting
+# Sent with 202 to ?async=1 requests while the real thumbnail is generated
+THUMBNAIL_PLACEHOLDER = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="300" height="225">'
+    '<rect width="100%" height="100%" fill="#222"/></svg>'
+)
+
+###############################################################################
+# V4L2 helpers (query devices without opening a capture stream)
+###############################################################################
+
+VIDIOC_QUERYCAP = 0x80685600  # _IOR('V', 0, struct v4l2_capability)
+VIDIOC_ENUM_FMT = 0xC0405602  # _IOWR('V', 2, struct v4l2_fmtdesc)
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+_V4L2_CAPABILITY = struct.Struct("16s32s32sIII12x")
+_V4L2_FMTDESC = struct.Struct("III32sII12x")
+
+def probe_v4l2(camera_id):
+    """
+    Check that /dev/video{camera_id} is a V4L2 capture device using VIDIOC_QUERYCAP.
+    The device is never streamed from, so FFmpeg can open it right after.
+    Raises OSError if the device is missing or unusable.
+    """
+    device_path = f"/dev/video{camera_id}"
+    fd = os.open(device_path, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        buf = bytearray(_V4L2_CAPABILITY.size)
+        fcntl.ioctl(fd, VIDIOC_QUERYCAP, buf)
+    finally:
+        os.close(fd)
+
+    driver, card, bus_info, _, capabilities, device_caps = _V4L2_CAPABILITY.unpack(buf)
+    if capabilities & V4L2_CAP_DEVICE_CAPS:
+        capabilities = device_caps
+    if not capabilities & V4L2_CAP_VIDEO_CAPTURE:
+        raise OSError(errno.ENODEV, "Not a video capture device", device_path)
+
+    return {
+        "driver": driver.rstrip(b"\0").decode(errors="replace"),
+        "card": card.rstrip(b"\0").decode(errors="replace"),
+        "bus_info": bus_info.rstrip(b"\0").decode(errors="replace"),
+        "capabilities": capabilities,
+    }
+
+def list_v4l2_formats(camera_id):
+    """List the capture pixel formats of a camera as lowercase fourccs (e.g. 'mjpg', 'yuyv')"""
+    formats = []
+    fd = os.open(f"/dev/video{camera_id}", os.O_RDWR | os.O_NONBLOCK)
+    try:
+        for index in range(64):
+            buf = bytearray(_V4L2_FMTDESC.pack(index, V4L2_BUF_TYPE_VIDEO_CAPTURE, 0, b"", 0, 0))
+            try:
+                fcntl.ioctl(fd, VIDIOC_ENUM_FMT, buf)
+            except OSError as e:
+                if e.errno == errno.EINVAL:  # End of the format list
+                    break
+                raise
+            pixelformat = _V4L2_FMTDESC.unpack(buf)[4]
+            formats.append(struct.pack("<I", pixelformat).decode("ascii", "replace").strip().lower())
+    finally:
+        os.close(fd)
+    return formats
 
 ###############################################################################
 # Helper functions to build FFmpeg commands
 ###############################################################################
 
-def build_ffmpeg_command(camera_id, outputs):
-    """Build FFmpeg command for reliable streaming"""
-    hls_directory = ensure_hls_directory(camera_id)
-    playlist_path = os.path.join(hls_directory, "playlist.m3u8")
-    recording_path = None
-    
-    if outputs.get("recording", {}).get("enabled", True):
-        timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-        recording_path = os.path.join(RECORDINGS_DIR, f"camera_{camera_id}_{timestamp}.mp4")
-
-    command = [
-        "ffmpeg",
-        "-y",
-        # Input options
-        "-f", "v4l2",
-        "-input_format", "mjpeg",
-        "-video_size", "640x480",
-        "-framerate", "30",
-        "-thread_queue_size", "512",  # Reduced queue size
+HW_ENCODERS = ("h264_v4l2m2m", "h264_vaapi", "h264_nvenc")  # In order of preference
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+def encoder_input_args(encoder):
+    """Global FFmpeg options the encoder needs ahead of the input"""
+    if encoder == "h264_vaapi":
+        return ["-vaapi_device", VAAPI_DEVICE]
+    return []
+
+def video_encoder_args(encoder, bitrate, x264_args):
+    """
+    Video encoding options for encoder. x264_args are the libx264 options of the
+    calling output and are only used for the software fallback.
+    """
+    if encoder == "h264_vaapi":
+        return [
+            "-vf", "format=nv12,hwupload",
+            "-c:v", "h264_vaapi",
+            "-b:v", bitrate,
+        ]
+    if encoder == "h264_nvenc":
+        return [
+            "-c:v", "h264_nvenc",
+            "-preset", "p1",
+            "-tune", "ll",
+            "-pix_fmt", "yuv420p",
+            "-b:v", bitrate,
+        ]
+    if encoder == "h264_v4l2m2m":
+        return [
+            "-c:v", "h264_v4l2m2m",
+            "-pix_fmt", "yuv420p",
+            "-b:v", bitrate,
+        ]
+    return ["-c:v", "libx264", *x264_args]
+
+def hw_encoder_works(encoder):
+    """Encode one test frame to check that the encoder has working hardware behind it"""
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        *encoder_input_args(encoder),
+        "-f", "lavfi", "-i", "testsrc=size=640x480:rate=30",
+        "-frames:v", "1",
+        *video_encoder_args(encoder, "1000k", []),
+        "-f", "null", "-"
+    ]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=10).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_encoders():
+    """FFmpeg's -encoders listing, or an empty string if it can't be run (listed once)"""
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            timeout=10
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Could not list FFmpeg encoders: {e}")
+        return ""
+    return result.stdout
+
+@functools.lru_cache(maxsize=None)
+def detect_hw_encoder():
+    """Pick the first working hardware H.264 encoder, falling back to libx264 (probed once)"""
+    encoders = ffmpeg_encoders()
+    for encoder in HW_ENCODERS:
+        if f" {encoder} " in encoders and hw_encoder_works(encoder):
+            logger.info(f"Using hardware encoder {encoder}")
+            return encoder
+
+    logger.info("No hardware encoder available, using libx264")
+    return "libx264"
+
+HW_DECODERS = ("vaapi", "cuda")  # Hardware decoders worth handing thumbnail decodes to
+
+@functools.lru_cache(maxsize=None)
+def detect_hw_decoder():
+    """Whether FFmpeg was built with a VAAPI or NVDEC hwaccel (probed once)"""
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-hwaccels"],
+            capture_output=True,
+            text=True,
+            timeout=10
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Could not list FFmpeg hwaccels: {e}")
+        return False
+    return any(hwaccel in result.stdout.split() for hwaccel in HW_DECODERS)
+
+# Invariant argv fragments of the command builders. The encoder dependent ones
+# are built on first use, so importing the app never waits on the FFmpeg probes.
+_V4L2_INPUT_ARGS = (
+    "-f", "v4l2",
+    "-input_format", "mjpeg",
+    "-video_size", "640x480",
+    "-framerate", "30",
+    "-thread_queue_size", "512",  # Reduced queue size
+)
+
+# libx264 threads per stream, matching the two CPUs wrap_with_sched pins it to.
+# Slice threading comes with -tune zerolatency.
+ENCODER_THREADS = "2"
+
+@functools.lru_cache(maxsize=None)
+def stream_input_args():
+    """Input options of build_ffmpeg_command"""
+    return (
+        *encoder_input_args(detect_hw_encoder()),
+        *_V4L2_INPUT_ARGS,
         "-probesize", "42M",
         "-analyzeduration", "10M",
-        "-i", f"/dev/video{camera_id}",  # Add input device
-    ]
+    )
 
-    # First output - MP4 Recording
-    if recording_path:
-        command.extend([
-            "-c:v", "libx264",
-            "-crf", "28",  # Lower quality but less CPU
-            "-preset", "superfast",  # Much faster encoding
+@functools.lru_cache(maxsize=None)
+def stream_encode_args():
+    """Single encode shared by the MP4 and HLS outputs of build_ffmpeg_command"""
+    return (
+        "-map", "0:v",
+        *video_encoder_args(detect_hw_encoder(), "800k", [
+            "-preset", "superfast",
+            "-tune", "zerolatency",
+            "-threads", ENCODER_THREADS,
             "-pix_fmt", "yuv420p",
-            "-r", "15",  # Lower framerate for recording
-            "-g", "60",
-            "-f", "mp4",
-            recording_path,
-        ])
-
-    # Second output - HLS Stream
-    command.extend([
-        "-c:v", "libx264",
-        "-preset", "superfast",
-        "-tune", "zerolatency",
-        "-pix_fmt", "yuv420p",
-        "-b:v", "800k",  # Lower bitrate
+            "-b:v", "800k",  # Lower bitrate
+        ]),
         "-bufsize", "400k",
         "-maxrate", "1000k",
-        "-g", "15",
+        "-g", "15",  # Keyframe every second so HLS can cut 2s segments
         "-keyint_min", "15",
         "-r", "15",  # Lower framerate
+    )
+
+_STREAM_HLS_OPTIONS = ":".join((
+    "f=hls",
+    "hls_time=2",  # Longer segments = less CPU
+    "hls_list_size=3",
+    "hls_init_time=2",
+    "hls_allow_cache=0",
+    "hls_segment_type=mpegts",
+    "start_number=0",
+    "hls_flags=delete_segments+append_list+omit_endlist+round_durations+temp_file",
+))
+
+@functools.lru_cache(maxsize=None)
+def low_latency_hls_args():
+    """Ultra low-latency encoding and muxing options of build_hls_command"""
+    return (
+        *video_encoder_args(detect_hw_encoder(), "800k", [
+            "-preset", "ultrafast",
+            "-tune", "zerolatency",
+            "-threads", ENCODER_THREADS,
+            "-sc_threshold", "0",
+            "-b:v", "800k",        # Slightly reduced bitrate
+            "-pix_fmt", "yuv420p",
+            "-profile:v", "baseline",
+            "-level", "3.0",
+        ]),
+        "-g", "10",             # Reduced GOP size
+        "-maxrate", "800k",
+        "-bufsize", "400k",     # Reduced buffer size
+        "-fps_mode", "vfr",     # Variable framerate mode
         "-f", "hls",
-        "-hls_time", "2",  # Longer segments = less CPU
-        "-hls_list_size", "3",
-        "-hls_init_time", "2",
-        "-hls_allow_cache", "0",
+        "-hls_time", "0.2",     # Very short segments
+        "-hls_list_size", "2",  # Keep only 2 segments
+        "-hls_flags", "delete_segments+append_list+omit_endlist+discont_start",
         "-hls_segment_type", "mpegts",
-        "-start_number", "0",
-        "-hls_flags",
-        "delete_segments+append_list+omit_endlist+round_durations+temp_file",
-        "-hls_segment_filename", f"{hls_directory}/segment%03d.ts",
-        playlist_path
-    ])
+        "-hls_start_number_source", "datetime",
+        "-start_number", "1",
+    )
 
-    return command
+_RECORDING_ARGS = (
+    "-c:v", "libx264",
+    "-preset", "ultrafast",
+    "-tune", "zerolatency",
+    "-threads", ENCODER_THREADS,
+    "-c:a", "aac",  # Missing audio support
+    "-f", "mp4",
+)
+
+
+def build_ffmpeg_command(camera_id, outputs):
+    """
+    Build FFmpeg command for reliable streaming. The camera is encoded once and
+    the tee muxer writes the same packets to the MP4 recording and the HLS stream.
+    """
+    hls_directory = ensure_hls_directory(camera_id)
+    playlist_path = f"{hls_directory}/playlist.m3u8"
+    hls_options = f"{_STREAM_HLS_OPTIONS}:hls_segment_filename={hls_directory}/segment%03d.ts"
+    
+    if not outputs.get("recording", {}).get("enabled", True):
+        return [
+            "ffmpeg", "-y",
+            *stream_input_args(),
+            "-i", f"/dev/video{camera_id}",
+            *stream_encode_args(),
+            "-f", "tee", f"[{hls_options}]{playlist_path}"
+        ]
+
+    recording_path = f"{RECORDINGS_DIR}/camera_{camera_id}_{time.strftime('%Y%m%d-%H%M%S')}.mp4"
+    return [
+        "ffmpeg", "-y",
+        *stream_input_args(),
+        "-i", f"/dev/video{camera_id}",
+        *stream_encode_args(),
+        # MP4 needs global headers; repeat SPS/PPS in-band so HLS segments stay decodable
+        "-flags", "+global_header",
+        "-f", "tee", f"[f=mp4]{recording_path}|[{hls_options}:bsfs/v=dump_extra]{playlist_path}"
+    ]
+
+# HLS directories already set up by ensure_hls_directory. Stopping a stream
+# only empties its directory, so they stay valid for the life of the process.
+_ensured_hls_dirs = set()
 
 def ensure_hls_directory(camera_id):
     """Ensure HLS directory exists with proper permissions"""
-    hls_directory = os.path.join("static", "hls", f"camera_{camera_id}")
+    hls_directory = f"static/hls/camera_{camera_id}"
+    if hls_directory in _ensured_hls_dirs:
+        return hls_directory
     try:
-        # Create directory with parents if it doesn't exist
-        Path(hls_directory).mkdir(parents=True, exist_ok=True)
-        # Set directory permissions to 755
-        os.chmod(hls_directory, 0o755)
-        # Create an empty playlist file to ensure write permissions
-        playlist_path = os.path.join(hls_directory, "playlist.m3u8")
-        Path(playlist_path).touch()
-        os.chmod(playlist_path, 0o644)
+        # static/hls itself is created by ensure_directories
+        try:
+            os.mkdir(hls_directory, 0o755)
+        except FileExistsError:
+            pass
+        # Set directory permissions to 755 (mkdir's mode is subject to the umask)
+        if os.stat(hls_directory).st_mode & 0o777 != 0o755:
+            os.chmod(hls_directory, 0o755)
+        # No playlist is pre-created: FFmpeg writes it with the first segment
+        _ensured_hls_dirs.add(hls_directory)
         return hls_directory
     except Exception as e:
         logger.error(f"Failed to create HLS directory: {str(e)}")
@@ -123,39 +411,14 @@ def build_hls_command(camera_id, outputs):
         return None
 
     hls_directory = ensure_hls_directory(camera_id)
-    playlist_path = os.path.join(hls_directory, "playlist.m3u8")
+    playlist_path = f"{hls_directory}/playlist.m3u8"
 
     return [
-        "ffmpeg",
-        "-y",
-        # Input options - Using MJPEG for better performance
-        "-f", "v4l2",
-        "-input_format", "mjpeg",  # Changed from yuyv422 to mjpeg
-        "-video_size", "640x480",
-        "-framerate", "30",
-        "-thread_queue_size", "512",  # Reduced buffer size
+        "ffmpeg", "-y",
+        *encoder_input_args(detect_hw_encoder()),
+        *_V4L2_INPUT_ARGS,
         "-i", f"/dev/video{camera_id}",
-        # Ultra low-latency encoding options
-        "-c:v", "libx264",
-        "-preset", "ultrafast",
-        "-tune", "zerolatency",
-        "-g", "10",             # Reduced GOP size
-        "-sc_threshold", "0",
-        "-b:v", "800k",        # Slightly reduced bitrate
-        "-maxrate", "800k",
-        "-bufsize", "400k",     # Reduced buffer size
-        "-pix_fmt", "yuv420p",
-        "-profile:v", "baseline",
-        "-level", "3.0",
-        "-fps_mode", "vfr",     # Variable framerate mode
-        # HLS specific options for ultra-low latency
-        "-f", "hls",
-        "-hls_time", "0.2",     # Very short segments
-        "-hls_list_size", "2",  # Keep only 2 segments
-        "-hls_flags", "delete_segments+append_list+omit_endlist+discont_start",
-        "-hls_segment_type", "mpegts",
-        "-hls_start_number_source", "datetime",
-        "-start_number", "1",
+        *low_latency_hls_args(),
         "-hls_segment_filename", f"{hls_directory}/segment%03d.ts",
         playlist_path
     ]
@@ -167,21 +430,9 @@ def build_recording_command(camera_id, outputs):
         return None
 
     os.makedirs(RECORDINGS_DIR, exist_ok=True)
-    filename = f"camera_{camera_id}_{datetime.now().strftime('%Y%m%d-%H%M%S')}.mp4"
-    filepath = os.path.join(RECORDINGS_DIR, filename)
+    filepath = f"{RECORDINGS_DIR}/camera_{camera_id}_{time.strftime('%Y%m%d-%H%M%S')}.mp4"
 
-    return [
-        "ffmpeg",
-        "-y",
-        "-f", "v4l2",
-        "-i", f"/dev/video{camera_id}",
-        "-c:v", "libx264",
-        "-preset", "ultrafast",
-        "-tune", "zerolatency",
-        "-c:a", "aac",  # Missing audio support
-        "-f", "mp4",
-        filepath
-    ]
+    return ["ffmpeg", "-y", "-f", "v4l2", "-i", f"/dev/video{camera_id}", *_RECORDING_ARGS, filepath]
 
 def verify_camera_access(camera_id):
     """Verify that the camera exists and is accessible"""
@@ -190,17 +441,24 @@ def verify_camera_access(camera_id):
         if not os.path.exists(device_path):
             return False, f"Camera device {device_path} not found"
             
-        # Try to open the camera with OpenCV
-        cap = cv2.VideoCapture(int(camera_id))
-        if not cap.isOpened():
-            return False, "Failed to open camera with OpenCV"
+        # Query the device instead of opening a capture stream
+        try:
+            probe_v4l2(camera_id)
+        except OSError as e:
+            if e.errno != errno.ENOTTY:
+                return False, f"Failed to query camera: {e}"
             
-        # Try to read a frame
-        ret, frame = cap.read()
-        cap.release()
-        
-        if not ret or frame is None:
-            return False, "Failed to read frame from camera"
+            # Not answering V4L2 ioctls; try to open the camera with OpenCV
+            cap = cv2.VideoCapture(int(camera_id))
+            if not cap.isOpened():
+                return False, "Failed to open camera with OpenCV"
+                
+            # Try to read a frame
+            ret, frame = cap.read()
+            cap.release()
+            
+            if not ret or frame is None:
+                return False, "Failed to read frame from camera"
             
         logger.info(f"Successfully verified camera {camera_id}")
         return True, "Camera is accessible"
@@ -211,67 +469,126 @@ def verify_camera_access(camera_id):
 def test_camera_capture(camera_id):
     """Test camera capture and determine working format"""
     try:
-        cap = cv2.VideoCapture(int(camera_id))
-        if not cap.isOpened():
-            raise Exception(f"Failed to open camera {camera_id}")
-
-        # Try to set YUYV format
-        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('Y', 'U', 'Y', 'V'))
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-        cap.set(cv2.CAP_PROP_FPS, 30)
-
-        ret, frame = cap.read()
-        if not ret:
-            raise Exception(f"Failed to capture frame from camera {camera_id}")
+        try:
+            probe_v4l2(camera_id)
+            formats = list_v4l2_formats(camera_id)
+        except OSError as e:
+            if e.errno != errno.ENOTTY:
+                raise
+            return test_camera_capture_opencv(camera_id)
 
-        # Get actual format being used
-        format_code = int(cap.get(cv2.CAP_PROP_FOURCC))
-        format_name = "".join([chr((format_code >> 8 * i) & 0xFF) for i in range(4)])
+        if not formats:
+            raise Exception(f"Camera {camera_id} reports no capture formats")
 
-        cap.release()
-        return format_name.lower()
+        # Prefer YUYV, otherwise report the first format the camera offers
+        return "yuyv" if "yuyv" in formats else formats[0]
 
     except Exception as e:
         logger.error(f"Error testing camera {camera_id}: {e}")
         raise
 
+def test_camera_capture_opencv(camera_id):
+    """Determine the working format by capturing a frame with OpenCV"""
+    cap = cv2.VideoCapture(int(camera_id))
+    if not cap.isOpened():
+        raise Exception(f"Failed to open camera {camera_id}")
+
+    # Try to set YUYV format
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('Y', 'U', 'Y', 'V'))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+    cap.set(cv2.CAP_PROP_FPS, 30)
+
+    ret, frame = cap.read()
+    if not ret:
+        raise Exception(f"Failed to capture frame from camera {camera_id}")
+
+    # Get actual format being used
+    format_code = int(cap.get(cv2.CAP_PROP_FOURCC))
+    format_name = "".join([chr((format_code >> 8 * i) & 0xFF) for i in range(4)])
+
+    cap.release()
+    return format_name.lower()
+
+# A single daemon thread drains the stderr pipes of all FFmpeg processes
+_stderr_selector = selectors.DefaultSelector()
+_stderr_partial_lines = {}  # fd -> bytes of an unterminated line
+_stderr_pump_lock = Lock()
+_stderr_pump_thread = None
+
+def handle_ffmpeg_line(process, camera_id, line):
+    """Log an FFmpeg output line; returns False if the process was killed"""
+    logger.info(f"FFmpeg camera {camera_id}: {line}")
+    if "error" in line.lower():
+        logger.error(f"FFmpeg error for camera {camera_id}: {line}")
+        # Kill the process if there's a critical error
+        if "baseline profile doesn't support" in line or "Invalid data" in line:
+            process.kill()
+            return False
+    return True
+
+def unwatch_ffmpeg_output(process):
+    """Stop pumping the stderr of an FFmpeg process and close the pipe"""
+    try:
+        key = _stderr_selector.unregister(process.stderr)
+    except (KeyError, ValueError):
+        return  # Already unregistered
+    _stderr_partial_lines.pop(key.fd, None)
+    process.stderr.close()
+
+def pump_ffmpeg_output():
+    """Read whatever FFmpeg processes have written to stderr and dispatch it line by line"""
+    while True:
+        for key, _ in _stderr_selector.select(timeout=1.0):
+            camera_id, process = key.data
+            try:
+                chunk = os.read(key.fd, 65536)
+            except BlockingIOError:
+                continue
+            except OSError:
+                chunk = b""
+
+            if not chunk:
+                # FFmpeg exited and closed its end of the pipe
+                line = _stderr_partial_lines.pop(key.fd, b"").decode(errors="replace").strip()
+                if line:
+                    handle_ffmpeg_line(process, camera_id, line)
+                unwatch_ffmpeg_output(process)
+                continue
+
+            # Progress updates end in "\r" rather than "\n"
+            lines = (_stderr_partial_lines.pop(key.fd, b"") + chunk.replace(b"\r", b"\n")).split(b"\n")
+            _stderr_partial_lines[key.fd] = lines.pop()
+            for raw_line in lines:
+                line = raw_line.decode(errors="replace").strip()
+                if line and not handle_ffmpeg_line(process, camera_id, line):
+                    unwatch_ffmpeg_output(process)
+                    break
+
 def monitor_ffmpeg_output(process, camera_id):
-    """Monitor FFmpeg process output in a separate thread"""
-    def _monitor():
-        while True:
-            line = process.stderr.readline()
-            if not line:
-                break
-            line = line.strip()
-            if line:
-                logger.info(f"FFmpeg camera {camera_id}: {line}")
-                if "error" in line.lower():
-                    logger.error(f"FFmpeg error for camera {camera_id}: {line}")
-                    # Kill the process if there's a critical error
-                    if "baseline profile doesn't support" in line or "Invalid data" in line:
-                        process.kill()
-                        break
+    """Monitor FFmpeg process output from the shared stderr pump thread"""
+    global _stderr_pump_thread
+
+    os.set_blocking(process.stderr.fileno(), False)
+    _stderr_selector.register(process.stderr, selectors.EVENT_READ, data=(camera_id, process))
 
-    thread = threading.Thread(target=_monitor, daemon=True)
-    thread.start()
-    return thread
+    with _stderr_pump_lock:
+        if _stderr_pump_thread is None:
+            _stderr_pump_thread = threading.Thread(target=pump_ffmpeg_output, daemon=True)
+            _stderr_pump_thread.start()
 
 def cleanup_hls_files(camera_id):
     """Clean up HLS files before starting new stream"""
     try:
         hls_directory = os.path.join("static", "hls", f"camera_{camera_id}")
-        if os.path.exists(hls_directory):
-            for file in os.listdir(hls_directory):
+        with os.scandir(hls_directory) as entries:
+            for entry in entries:
                 try:
-                    os.remove(os.path.join(hls_directory, file))
-                except Exception as e:
+                    os.unlink(entry.path)
+                except OSError as e:
                     logger.warning(f"Failed to remove file: {e}")
-        
-        # Recreate directory
-        Path(hls_directory).mkdir(parents=True, exist_ok=True)
-        os.chmod(hls_directory, 0o755)
-        
+    except FileNotFoundError:
+        pass  # Nothing to clean up
     except Exception as e:
         logger.error(f"Error cleaning up HLS files: {e}")
 
@@ -326,22 +643,28 @@ def ensure_camera_format(camera_id):
     except Exception as e:
         logger.error(f"Error setting camera format: {e}")
 
+def segment_sort_key(entry):
+    """Order segment files by sequence number (segment999.ts before segment1000.ts)"""
+    return len(entry.name), entry.name
+
 def cleanup_old_segments(camera_id):
     """Clean up old HLS segments to prevent disk space issues"""
     try:
         hls_directory = os.path.join("static", "hls", f"camera_{camera_id}")
         if os.path.exists(hls_directory):
-            # Get all .ts files
-            segments = sorted(Path(hls_directory).glob("segment*.ts"))
+            with os.scandir(hls_directory) as entries:
+                segments = [e for e in entries if e.name.startswith("segment") and e.name.endswith(".ts")]
             
             # Keep only the latest 10 segments
-            segments_to_delete = segments[:-10] if len(segments) > 10 else []
+            keep = {e.name for e in heapq.nlargest(10, segments, key=segment_sort_key)}
             
-            for segment in segments_to_delete:
+            for segment in segments:
+                if segment.name in keep:
+                    continue
                 try:
-                    os.remove(segment)
+                    os.unlink(segment.path)
                 except Exception as e:
-                    logger.warning(f"Failed to remove old segment {segment}: {e}")
+                    logger.warning(f"Failed to remove old segment {segment.path}: {e}")
                     
     except Exception as e:
         logger.error(f"Error cleaning up segments for camera {camera_id}: {e}")
@@ -349,13 +672,15 @@ def cleanup_old_segments(camera_id):
 def is_camera_available(camera_id):
     """Check if the camera is available and not in use"""
     try:
-        device_path = f"/dev/video{camera_id}"
-        cap = cv2.VideoCapture(camera_id)
-        if cap.isOpened():
-            cap.release()
-            return True
-        return False
-    except Exception as e:
+        probe_v4l2(camera_id)
+        return True
+    except OSError as e:
+        if e.errno == errno.ENOTTY:
+            # Not answering V4L2 ioctls; fall back to opening it with OpenCV
+            cap = cv2.VideoCapture(int(camera_id))
+            if cap.isOpened():
+                cap.release()
+                return True
         logger.error(f"Error checking camera {camera_id}: {e}")
         return False
 
@@ -363,15 +688,22 @@ def verify_video_segments(camera_id):
     """Verify that video segments are being created with valid content"""
     try:
         hls_directory = os.path.join("static", "hls", f"camera_{camera_id}")
-        segments = list(Path(hls_directory).glob("segment*.ts"))
+        latest_segment = None
+        latest_stat = None
+        with os.scandir(hls_directory) as entries:
+            for entry in entries:
+                if not (entry.name.startswith("segment") and entry.name.endswith(".ts")):
+                    continue
+                stat = entry.stat()
+                if latest_stat is None or stat.st_mtime > latest_stat.st_mtime:
+                    latest_segment, latest_stat = entry.path, stat
         
-        if not segments:
+        if latest_segment is None:
             logger.error(f"No segments found in {hls_directory}")
             return False
             
         # Check the size of the latest segment
-        latest_segment = max(segments, key=lambda p: p.stat().st_mtime)
-        size = latest_segment.stat().st_size
+        size = latest_stat.st_size
         
         if size < 1000:  # Less than 1KB is probably invalid
             logger.error(f"Latest segment {latest_segment} is too small: {size} bytes")
@@ -387,95 +719,90 @@ def verify_video_segments(camera_id):
 def get_camera_format(camera_id):
     """Get supported formats for the camera"""
     try:
-        result = subprocess.run(
-            ['v4l2-ctl', '--device', f'/dev/video{camera_id}', '--list-formats'],
-            capture_output=True,
-            text=True
-        )
-        logger.info(f"Camera {camera_id} formats: {result.stdout}")
-        return "mjpeg" if "MJPG" in result.stdout else "yuyv422"
-    except:
+        formats = list_v4l2_formats(camera_id)
+        logger.info(f"Camera {camera_id} formats: {formats}")
+        return "mjpeg" if "mjpg" in formats else "yuyv422"
+    except OSError:
         return "yuyv422"  # Default to YUYV if can't determine
 
+# Per-stream cost of each resolution, one row per entry of CAPACITY_RESOLUTIONS.
+# CPU estimates assume encoders capped at ENCODER_THREADS.
+CAPACITY_RESOLUTIONS = ('1080p', '720p', '480p', '360p')
+CAPACITY_TABLE = np.array([
+    # CPU % per stream, memory GB per stream, Mbps per stream, max streams
+    [45, 0.75, 10, 4],
+    [30, 0.5,  7,  6],
+    [20, 0.35, 4,  8],
+    [12, 0.25, 2,  12],
+])
+
 def calculate_camera_capacity(cpu_count, available_memory_gb, cpu_usage, memory_usage):
     """Calculate estimated camera capacity based on system resources"""
     try:
-        # CPU usage estimates per resolution (percentage per stream)
-        cpu_usage_per_camera = {
-            '1080p': 50,  # 50% CPU per stream (more realistic for high quality)
-            '720p': 35,   # 35% CPU per stream
-            '480p': 25,   # 25% CPU per stream
-            '360p': 15    # 15% CPU per stream
-        }
-        
-        # Memory usage estimates per resolution (GB per stream)
-        memory_per_camera = {
-            '1080p': 0.75,   # 750MB per stream
-            '720p': 0.5,    # 500MB per stream
-            '480p': 0.35,   # 350MB per stream
-            '360p': 0.25    # 250MB per stream
-        }
-        
         # Calculate available resources (leave 30% headroom instead of 20%)
         available_cpu = max(0, (100 - cpu_usage - 30) * cpu_count)  # Leave 30% headroom
         available_memory = max(0, available_memory_gb * 0.7)  # Leave 30% memory free
         
-        # Network bandwidth estimation (Mbps)
-        bandwidth_per_camera = {
-            '1080p': 10,   # 10 Mbps for 1080p
-            '720p': 7,     # 7 Mbps for 720p
-            '480p': 4,     # 4 Mbps for 480p
-            '360p': 2      # 2 Mbps for 360p
-        }
-        
         # Assume 1Gbps network capacity with 50% utilization (more conservative)
         available_bandwidth = 1000 * 0.5  # 500 Mbps usable
         
-        # Calculate maximum cameras for each resolution
-        max_cameras = {}
-        for resolution in cpu_usage_per_camera:
-            cpu_limit = int(available_cpu / cpu_usage_per_camera[resolution])
-            mem_limit = int(available_memory / memory_per_camera[resolution])
-            bandwidth_limit = int(available_bandwidth / bandwidth_per_camera[resolution])
-            
-            # Use the lowest of all three limits
-            max_cameras[resolution] = min(cpu_limit, mem_limit, bandwidth_limit)
-            
-            # Add more conservative maximum limits
-            if resolution == '1080p':
-                max_cameras[resolution] = min(max_cameras[resolution], 4)  # Max 4 1080p streams
-            elif resolution == '720p':
-                max_cameras[resolution] = min(max_cameras[resolution], 6)  # Max 6 720p streams
-            elif resolution == '480p':
-                max_cameras[resolution] = min(max_cameras[resolution], 8)  # Max 8 480p streams
-            elif resolution == '360p':
-                max_cameras[resolution] = min(max_cameras[resolution], 12)  # Max 12 360p streams
-        
-        return max_cameras
+        # Lowest of the CPU, memory, bandwidth and hard limits for every resolution at once
+        limits = np.minimum.reduce([
+            available_cpu / CAPACITY_TABLE[:, 0],
+            available_memory / CAPACITY_TABLE[:, 1],
+            available_bandwidth / CAPACITY_TABLE[:, 2],
+            CAPACITY_TABLE[:, 3],
+        ]).astype(int)
+        return dict(zip(CAPACITY_RESOLUTIONS, limits.tolist()))
         
     except Exception as e:
         logger.error(f"Error calculating camera capacity: {e}")
-        return {
-            '1080p': 0,
-            '720p': 0,
-            '480p': 0,
-            '360p': 0
-        }
+        return dict.fromkeys(CAPACITY_RESOLUTIONS, 0)
+
+CPU_COUNT = psutil.cpu_count(logical=True)  # Does not change while running
+RESOURCE_SAMPLE_INTERVAL = 1.0  # Seconds each CPU sample is measured over
+
+# Latest sample taken by resource_sampler. Replaced as a whole, never mutated,
+# so request handlers can read it without a lock.
+_resource_snapshot = {}
+
+def sample_resources(interval):
+    """Measure CPU usage over interval seconds (None: since the previous call) plus memory and disk"""
+    cpu_percent_per_core = psutil.cpu_percent(interval=interval, percpu=True)
+    return {
+        "cpu_percent": sum(cpu_percent_per_core) / len(cpu_percent_per_core),
+        "cpu_percent_per_core": cpu_percent_per_core,
+        "memory": psutil.virtual_memory(),
+        "disk": psutil.disk_usage('/'),
+    }
+
+def resource_sampler():
+    """Keep _resource_snapshot at most RESOURCE_SAMPLE_INTERVAL seconds old"""
+    global _resource_snapshot
+    while True:
+        try:
+            _resource_snapshot = sample_resources(RESOURCE_SAMPLE_INTERVAL)
+        except Exception as e:
+            logger.warning(f"Error sampling system resources: {e}")
+            time.sleep(RESOURCE_SAMPLE_INTERVAL)
+
+def get_resource_snapshot():
+    """Return the latest resource sample (a short fresh one until the sampler's first is ready)"""
+    return _resource_snapshot or sample_resources(0.1)
 
 def get_system_resources():
     """Get system resources and estimated camera capacity"""
     try:
-        # CPU Info - Add small delay for accurate reading
-        psutil.cpu_percent(interval=None)  # First call to initialize
-        cpu_percent_per_core = psutil.cpu_percent(interval=0.5, percpu=True)
-        total_cpu_percent = sum(cpu_percent_per_core) / len(cpu_percent_per_core)
-        cpu_count = psutil.cpu_count(logical=True)
+        snapshot = get_resource_snapshot()
+        cpu_percent_per_core = snapshot["cpu_percent_per_core"]
+        total_cpu_percent = snapshot["cpu_percent"]
+        cpu_count = CPU_COUNT
         
         # Memory Info
-        memory = psutil.virtual_memory()
+        memory = snapshot["memory"]
         
         # Disk Info
-        disk = psutil.disk_usage('/')
+        disk = snapshot["disk"]
         
         # Calculate estimated camera capacity
         estimated_capacity = calculate_camera_capacity(
@@ -485,17 +812,19 @@ def get_system_resources():
             memory_usage=memory.percent
         )
         
-        # Round floating point values for cleaner display
-        memory_total = round(memory.total / (1024**3), 1)
-        memory_available = round(memory.available / (1024**3), 1)
-        disk_total = round(disk.total / (1024**3), 1)
-        disk_free = round(disk.free / (1024**3), 1)
-        disk_percent = round((disk.used / disk.total) * 100, 1)
+        # Round floating point values for cleaner display, all in one call
+        memory_total, memory_available, disk_total, disk_free, disk_percent = np.round([
+            memory.total / (1024**3),
+            memory.available / (1024**3),
+            disk.total / (1024**3),
+            disk.free / (1024**3),
+            (disk.used / disk.total) * 100
+        ], 1).tolist()
         
         return {
             "cpu": {
                 "percent_used": round(total_cpu_percent, 1),
-                "per_core_usage": [round(x, 1) for x in cpu_percent_per_core],
+                "per_core_usage": np.round(cpu_percent_per_core, 1).tolist(),
                 "core_count": cpu_count
             },
             "memory": {
@@ -514,31 +843,49 @@ def get_system_resources():
         logger.exception(f"Error getting system resources: {e}")
         return None
 
-def set_cpu_affinity(process, camera_id):
-    """Set CPU affinity for FFmpeg process to distribute load"""
-    try:
-        p = psutil.Process(process.pid)
-        cpu_count = psutil.cpu_count()
-        # Distribute processes across CPUs
-        cpu_set = {(int(camera_id) * 2) % cpu_count, 
-                  (int(camera_id) * 2 + 1) % cpu_count}
-        p.cpu_affinity(list(cpu_set))
-    except Exception as e:
-        logger.warning(f"Could not set CPU affinity: {e}")
+# Resolved once; without util-linux taskset FFmpeg just runs unpinned
+TASKSET = shutil.which("taskset")
+NICE = shutil.which("nice")
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE = shutil.which("ffprobe") or "ffprobe"
 
-def set_process_priority(process):
-    """Set FFmpeg process priority to below normal"""
-    try:
-        p = psutil.Process(process.pid)
-        p.nice(10)  # Lower priority (higher number = lower priority)
-    except Exception as e:
-        logger.warning(f"Could not set process priority: {e}")
+def wrap_with_sched(cmd, camera_id):
+    """Prefix an FFmpeg argv so it starts pinned to the camera's CPUs at lower priority"""
+    # Applied before exec, so every encoder thread FFmpeg spawns inherits it
+    if NICE:
+        cmd = [NICE, "-n", "10", *cmd]  # Lower priority (higher number = lower priority)
+    if TASKSET:
+        # Distribute processes across the CPUs this process may use; its cpuset or
+        # affinity (containers, systemd CPUAffinity=) can exclude some of CPU_COUNT
+        allowed = sorted(os.sched_getaffinity(0))
+        cpus = sorted({allowed[(int(camera_id) * 2) % len(allowed)],
+                       allowed[(int(camera_id) * 2 + 1) % len(allowed)]})
+        cmd = [TASKSET, "-c", ",".join(map(str, cpus)), *cmd]
+    return cmd
+
+def spawn_ffmpeg(cmd, camera_id):
+    """
+    Start an FFmpeg command pinned and niced. Popen can then use posix_spawn
+    (vfork-style, no copy of this process's page tables) instead of fork+exec.
+    """
+    argv = wrap_with_sched(cmd, camera_id)
+    return subprocess.Popen(
+        argv,
+        # posix_spawn is only used for an executable given with its directory
+        executable=argv[0] if os.path.dirname(argv[0]) else shutil.which(argv[0]),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,  # Raw bytes, read and decoded by the stderr pump
+        # Our own fds are non-inheritable already (PEP 446); closing them in the
+        # child would force the fork+exec path
+        close_fds=False
+    )
 
 def check_system_load():
     """Check if system has enough resources for new stream"""
     try:
-        cpu_percent = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory()
+        snapshot = get_resource_snapshot()
+        cpu_percent = snapshot["cpu_percent"]
+        memory = snapshot["memory"]
         
         # Don't start new streams if system is too loaded
         if cpu_percent > 80:
@@ -565,50 +912,72 @@ def start_streams():
         
         logger.info(f"Attempting to start cameras: {cameras}")
         
-        for camera_id in cameras:
-            try:
-                logger.info(f"Starting camera {camera_id}")
-                
-                # Build FFmpeg command
-                cmd = build_ffmpeg_command(camera_id, data.get("outputs", {}))
-                logger.info(f"Starting FFmpeg: {' '.join(cmd)}")
-                
-                # Check if device exists
-                if not os.path.exists(f"/dev/video{camera_id}"):
-                    raise Exception(f"Camera device /dev/video{camera_id} not found")
-                
-                # Start FFmpeg process
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    universal_newlines=True,
-                    bufsize=1  # Line buffered
-                )
-                
-                # Wait a short time to check if process started successfully
+        spawned = {}  # camera id -> FFmpeg process started by this request
+        errors = {}
+        
+        with ExitStack() as locks:
+            # Always taken in the same order, so overlapping requests can't deadlock
+            for camera_id in sorted(set(cameras), key=str):
+                locks.enter_context(camera_locks[camera_id])
+            
+            # Spawn every FFmpeg back to back
+            for camera_id in cameras:
+                try:
+                    logger.info(f"Starting camera {camera_id}")
+                    
+                    # Build FFmpeg command
+                    cmd = build_ffmpeg_command(camera_id, data.get("outputs", {}))
+                    logger.info(f"Starting FFmpeg: {' '.join(cmd)}")
+                    
+                    # Check if device exists
+                    if not os.path.exists(f"/dev/video{camera_id}"):
+                        raise Exception(f"Camera device /dev/video{camera_id} not found")
+                    
+                    # Start FFmpeg process, already pinned and niced
+                    spawned[camera_id] = spawn_ffmpeg(cmd, camera_id)
+                    
+                except Exception as e:
+                    errors[camera_id] = str(e)
+            
+            # Wait a short time, once for all cameras, to check they started successfully
+            if spawned:
                 time.sleep(1)
+            for camera_id, process in spawned.items():
                 if process.poll() is not None:
                     # Process already terminated
                     out, err = process.communicate()
-                    raise Exception(f"FFmpeg failed to start: {err}")
-                
-                # Store process reference
-                with process_lock:
-                    active_ffmpeg_processes[camera_id] = {
-                        "main": process,
-                        "start_time": time.time()
-                    }
+                    errors[camera_id] = f"FFmpeg failed to start: {err.decode(errors='replace')}"
+            
+            if errors:
+                # Don't leave part of the request running
+                survivors = [process for camera_id, process in spawned.items() if camera_id not in errors]
+                for process in survivors:
+                    process.terminate()
+                for process in survivors:
+                    try:
+                        process.wait(timeout=5)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+                        process.wait()
                 
-                # Set process priority and CPU affinity
-                set_cpu_affinity(process, camera_id)
-                set_process_priority(process)
+                for camera_id, error in errors.items():
+                    logger.error(f"Error starting camera {camera_id}: {error}")
+                return jsonify({
+                    "error": "; ".join(f"Failed to start camera {camera_id}: {error}" for camera_id, error in errors.items()),
+                    "errors": errors
+                }), 500
+            
+            for camera_id, process in spawned.items():
+                # Drain FFmpeg's stderr so a full pipe never blocks it
+                monitor_ffmpeg_output(process, camera_id)
                 
-            except Exception as e:
-                logger.error(f"Error starting camera {camera_id}: {str(e)}")
-                return jsonify({"error": f"Failed to start camera {camera_id}: {str(e)}"}), 500
-        
-        return jsonify({"status": "success"})
+                # Store process reference
+                active_ffmpeg_processes[camera_id] = {
+                    "main": process,
+                    "start_time": time.time()
+                }
+            
+            return jsonify({"status": "success"})
         
     except Exception as e:
         logger.error(f"Error in start_streams: {str(e)}")
@@ -620,18 +989,22 @@ def stop_streams():
     stopped = []
     errors = {}
 
-    with process_lock:
-        for camera_id, procs in list(active_ffmpeg_processes.items()):
+    for camera_id in list(active_ffmpeg_processes):
+        with camera_locks[camera_id]:
+            procs = active_ffmpeg_processes.get(camera_id)
+            if procs is None:
+                continue  # Stopped by a concurrent request
             try:
                 # Stop processes
                 for proc_type, proc in procs.items():
-                    if proc:
+                    if isinstance(proc, subprocess.Popen):
                         proc.terminate()
                         try:
                             proc.wait(timeout=5)
                         except subprocess.TimeoutExpired:
                             proc.kill()
                             proc.wait()
+                        unwatch_ffmpeg_output(proc)
                 
                 # Force release camera
                 release_camera(camera_id)
@@ -639,6 +1012,9 @@ def stop_streams():
                 # Cleanup HLS files
                 cleanup_hls_files(camera_id)
                 
+                # FFmpeg has written the MP4 trailer, so the recording can be thumbnailed now
+                precompute_thumbnails(camera_id)
+                
                 stopped.append(camera_id)
                 del active_ffmpeg_processes[camera_id]
                 
@@ -659,10 +1035,9 @@ def status():
     process is running.
     """
     status_info = {}
-    with process_lock:
-        for camera_id, procs in active_ffmpeg_processes.items():
-            main_running = procs.get("main") and (procs.get("main").poll() is None)
-            status_info[camera_id] = {"main": main_running}
+    for camera_id, procs in list(active_ffmpeg_processes.items()):
+        main_running = procs.get("main") and (procs.get("main").poll() is None)
+        status_info[camera_id] = {"main": main_running}
     return jsonify({"active_streams": status_info}), 200
 
 # Add static file serving for HLS and recordings
@@ -670,46 +1045,82 @@ def status():
 def serve_hls(filename):
     return send_from_directory("hls", filename)
 
-@app.route('/api/recordings')
-def list_recordings():
-    """List all recordings with metadata"""
-    try:
-        recordings = []
-        for file in os.listdir(RECORDINGS_DIR):
-            if file.endswith('.mp4'):
-                file_path = os.path.join(RECORDINGS_DIR, file)
-                stat = os.stat(file_path)
+# (RECORDINGS_DIR mtime, time listed, sorted recordings) of the last listing
+_recordings_cache = None
+RECORDINGS_CACHE_TTL = 5  # Seconds; bounds how stale sizes of in-progress recordings get
+
+def scan_recordings():
+    """List recording metadata, newest first, reusing the last listing while the directory is unchanged"""
+    global _recordings_cache
+    dir_mtime = os.stat(RECORDINGS_DIR).st_mtime_ns
+    now = time.monotonic()
+    cache = _recordings_cache
+    if cache and cache[0] == dir_mtime and now - cache[1] < RECORDINGS_CACHE_TTL:
+        return cache[2]
+
+    recordings = []
+    # Scanned by its resolved path, so entry.path is what recording_file_path resolves names to
+    with os.scandir(RECORDINGS_ROOT) as entries:
+        for entry in entries:
+            if entry.name.endswith('.mp4'):
+                stat = entry.stat()
+                parts = entry.name[:-4].split('_')
                 recordings.append({
-                    'filename': file,
+                    'filename': entry.name,
                     'size': stat.st_size,
                     'created': stat.st_mtime,
-                    'camera_id': file.split('_')[1],
-                    'timestamp': file.split('_')[2].replace('.mp4', '')
+                    'camera_id': parts[1],
+                    'timestamp': parts[2],
+                    # Versioned, so browsers may keep it for good and still see a replaced recording
+                    'thumbnail': f"/api/recordings/{entry.name}/thumbnail?v={thumbnail_key(entry.path, stat)}"
                 })
+    recordings.sort(key=lambda x: x['created'], reverse=True)
+    _recordings_cache = (dir_mtime, now, recordings)
+    return recordings
+
+@app.route('/api/recordings')
+def list_recordings():
+    """List all recordings with metadata"""
+    try:
         return jsonify({
             'status': 'success',
-            'recordings': sorted(recordings, key=lambda x: x['created'], reverse=True)
+            'recordings': scan_recordings()
         })
     except Exception as e:
         logger.error(f"Error listing recordings: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+RECORDINGS_ROOT = os.path.realpath(RECORDINGS_DIR)
+
+def recording_file_path(recording):
+    """Resolve a recording name inside RECORDINGS_DIR, or None if it points anywhere else"""
+    file_path = os.path.realpath(os.path.join(RECORDINGS_ROOT, recording))
+    if file_path == RECORDINGS_ROOT or os.path.commonpath([RECORDINGS_ROOT, file_path]) != RECORDINGS_ROOT:
+        return None
+    return file_path
+
 @app.route('/api/recordings/<recording>')
 def serve_recording(recording):
     """Serve a recording file"""
     try:
-        if '..' in recording or '/' in recording:
+        file_path = recording_file_path(recording)
+        if file_path is None:
             return jsonify({'error': 'Invalid filename'}), 400
             
-        file_path = os.path.join(RECORDINGS_DIR, recording)
         if not os.path.exists(file_path):
             return jsonify({'error': 'Recording not found'}), 404
             
+        # Werkzeug hands the open file to the server's wsgi.file_wrapper (sendfile()
+        # under gunicorn); conditional enables Range requests and 304 revalidation
         download = request.args.get('download', 'false').lower() == 'true'
-        if download:
-            return send_file(file_path, as_attachment=True)
-        else:
-            return send_file(file_path)
+        return send_file(
+            file_path,
+            mimetype='video/mp4',
+            as_attachment=download,
+            conditional=True,
+            etag=True,
+            last_modified=os.path.getmtime(file_path)
+        )
             
     except Exception as e:
         logger.error(f"Error serving recording: {e}")
@@ -719,17 +1130,20 @@ def serve_recording(recording):
 def delete_recording(recording):
     """Delete a recording file"""
     try:
-        if '..' in recording or '/' in recording:
+        file_path = recording_file_path(recording)
+        if file_path is None:
             return jsonify({'error': 'Invalid filename'}), 400
             
-        file_path = os.path.join(RECORDINGS_DIR, recording)
         if not os.path.exists(file_path):
             return jsonify({'error': 'Recording not found'}), 404
             
-        # Delete thumbnail if it exists
-        thumbnail_path = os.path.join(RECORDINGS_DIR, f"thumb_{recording}.jpg")
-        if os.path.exists(thumbnail_path):
-            os.remove(thumbnail_path)
+        # Delete thumbnails if they exist
+        key = thumbnail_key(file_path, os.stat(file_path))
+        thumbnail_paths = glob.glob(os.path.join(THUMBNAILS_DIR, f"{key}_*"))
+        legacy_thumbnail_path = os.path.join(RECORDINGS_DIR, f"thumb_{recording}.jpg")
+        for path in (*thumbnail_paths, legacy_thumbnail_path):
+            if os.path.exists(path):
+                os.remove(path)
             
         # Delete recording
         os.remove(file_path)
@@ -745,7 +1159,10 @@ def admin_interface():
 
 @app.route('/static/<path:path>')
 def serve_static(path):
-    """Serve static files including HLS streams"""
+    """
+    Serve static files including HLS streams. Behind nginx, /static/hls/ is
+    served from disk and never reaches this route (see deploy/nginx.conf).
+    """
     return send_from_directory('static', path)
 
 @app.route('/api/check-stream/<camera_id>')
@@ -772,14 +1189,14 @@ def check_stream(camera_id):
         
         # Check FFmpeg process
         process_info = None
-        with process_lock:
-            if camera_id in active_ffmpeg_processes:
-                process = active_ffmpeg_processes[camera_id].get("main")
-                if process:
-                    process_info = {
-                        "pid": process.pid,
-                        "returncode": process.poll()
-                    }
+        procs = active_ffmpeg_processes.get(camera_id)
+        if procs:
+            process = procs.get("main")
+            if process:
+                process_info = {
+                    "pid": process.pid,
+                    "returncode": process.poll()
+                }
         
         return jsonify({
             "status": "ok",
@@ -803,29 +1220,417 @@ def system_resources():
 def recordings_page():
     return send_file('static/recordings.html')
 
+@functools.lru_cache(maxsize=None)
+def webp_supported():
+    """Whether thumbnails can be written as WebP: by Pillow when PyAV renders them, else by FFmpeg's libwebp"""
+    if av is not None:
+        return PIL.features.check("webp")
+    return " libwebp " in ffmpeg_encoders()
+
+# Thumbnails are written under this suffix and renamed into place once complete,
+# so anything at a cache path is a whole image
+THUMBNAIL_TMP_SUFFIX = ".tmp"
+
+def commit_thumbnail(thumbnail_path):
+    """Move a fully written thumbnail into the cache; returns whether there was one"""
+    tmp_path = thumbnail_path + THUMBNAIL_TMP_SUFFIX
+    try:
+        if os.stat(tmp_path).st_size == 0:
+            return False
+        os.replace(tmp_path, thumbnail_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def render_thumbnails(recording_path, targets, width=300):
+    """
+    Decode one keyframe per (timestamp, thumbnail_path) target with PyAV, opening
+    the recording once, and save each as a JPEG or WebP by its extension
+    """
+    with av.open(recording_path) as container:
+        stream = container.streams.video[0]
+        stream.codec_context.skip_frame = "NONKEY"
+        stream.codec_context.thread_count = 1  # Keyframes only; threads would just add startup cost
+        for timestamp, thumbnail_path in sorted(targets):
+            offset = int(timestamp * av.time_base)
+            if container.duration and container.duration > offset:
+                container.seek(offset)  # Lands on the keyframe at or before timestamp
+            else:
+                container.seek(0)
+            frame = next(container.decode(stream))
+            height = max(1, round(frame.height * width / frame.width))
+            image_format = "WEBP" if thumbnail_path.endswith(".webp") else "JPEG"
+            frame.to_image(width=width, height=height).save(
+                thumbnail_path + THUMBNAIL_TMP_SUFFIX, format=image_format, quality=80)
+            commit_thumbnail(thumbnail_path)
+
+def generate_thumbnail_sheet(recording_path, targets):
+    """
+    Write every (timestamp, thumbnail_path) target from a single FFmpeg run. Each
+    target gets its own input that seeks in the container and decodes keyframes
+    only, so nothing before the timestamp is decoded.
+    """
+    # One thread each for decoding and filtering: a handful of frames doesn't
+    # pay for thread startup, and concurrent workers would oversubscribe the CPUs
+    cmd = [
+        FFMPEG, '-y', '-nostdin', '-hide_banner', '-loglevel', 'error',
+        '-filter_threads', '1', '-filter_complex_threads', '1'
+    ]
+    hw_decode = detect_hw_decoder()  # With -hwaccel auto FFmpeg still decodes in software when no device is usable
+    for timestamp, _ in targets:
+        if hw_decode:
+            cmd += ['-hwaccel', 'auto']  # Frames come back in system memory, ready for scale
+        cmd += ['-ss', str(timestamp), '-skip_frame', 'nokey', '-threads', '1', '-i', recording_path]
+    for index, (_, thumbnail_path) in enumerate(targets):
+        cmd += [
+            '-map', f'{index}:v:0',
+            '-frames:v', '1',
+            '-fps_mode', 'vfr',
+            '-vf', 'scale=300:-1',
+        ]
+        if thumbnail_path.endswith('.webp'):
+            cmd += ['-c:v', 'libwebp', '-lossless', '0', '-quality', '75', '-preset', 'photo', '-f', 'webp']
+        else:
+            cmd += ['-c:v', 'mjpeg', '-f', 'image2', '-update', '1']
+        cmd.append(thumbnail_path + THUMBNAIL_TMP_SUFFIX)
+    # A full executable path and inherited fds let CPython use posix_spawn instead of
+    # fork+exec (our own fds are non-inheritable already, PEP 446)
+    try:
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, close_fds=False,
+                       check=True, timeout=THUMBNAIL_FFMPEG_TIMEOUT)
+    except subprocess.CalledProcessError as e:
+        logger.warning("FFmpeg could not thumbnail %s: %s", recording_path, e.stderr.decode(errors="replace").strip())
+        raise
+
+    # Seeking past the last keyframe yields no frame; use the first one instead
+    missed = [(0, thumbnail_path) for timestamp, thumbnail_path in targets
+              if not commit_thumbnail(thumbnail_path) and timestamp > 0]
+    if missed:
+        generate_thumbnail_sheet(recording_path, missed)
+
+# Thumbnails being generated: cache path -> Event set once the worker is done with it.
+# Requests for a thumbnail already in here wait on the same Event instead of queueing it again.
+_thumbnail_jobs = {}
+_thumbnail_jobs_lock = Lock()
+_thumbnail_queue = queue.Queue()  # (recording path, timestamp, cache path)
+# Upper bound on thumbnails decoded (or FFmpeg runs) at once. The workers live as
+# long as the app and decode with the PyAV already loaded here, so with PyAV no
+# thumbnail pays an FFmpeg process start.
+THUMBNAIL_WORKERS = CPU_COUNT
+
+def request_thumbnail(recording_path, timestamp, thumbnail_path):
+    """Queue a thumbnail for the worker, or join the pending job for it; returns its Event"""
+    with _thumbnail_jobs_lock:
+        done = _thumbnail_jobs.get(thumbnail_path)
+        if done is None:
+            done = _thumbnail_jobs[thumbnail_path] = threading.Event()
+            _thumbnail_queue.put((recording_path, timestamp, thumbnail_path))
+    return done
+
+# One queue per connected /api/thumbnails/events client
+_thumbnail_subscribers = set()
+_thumbnail_subscribers_lock = Lock()
+
+def publish_thumbnail_ready(recording_path, timestamp, key):
+    """Tell every events subscriber that a thumbnail can now be fetched from the cache"""
+    recording = os.path.basename(recording_path)
+    event = {
+        "recording": recording,
+        "t": timestamp,
+        "url": f"/api/recordings/{recording}/thumbnail?t={timestamp}&v={key}"
+    }
+    with _thumbnail_subscribers_lock:
+        for subscriber in _thumbnail_subscribers:
+            subscriber.put(event)
+
+# Cache path -> monotonic deadline before which a failed thumbnail isn't generated
+# (or logged) again, so a client retrying a broken recording can't loop FFmpeg
+_thumbnail_failures = {}
+
+def thumbnail_failed_recently(thumbnail_path):
+    return _thumbnail_failures.get(thumbnail_path, 0) > time.monotonic()
+
+def record_thumbnail_failure(thumbnail_path):
+    now = time.monotonic()
+    if len(_thumbnail_failures) >= 1024:
+        for path, deadline in list(_thumbnail_failures.items()):
+            if deadline <= now:
+                _thumbnail_failures.pop(path, None)
+    _thumbnail_failures[thumbnail_path] = now + THUMBNAIL_ERROR_TTL
+
+def thumbnail_worker():
+    """Generate queued thumbnails, batching all pending timestamps of a recording into one decode"""
+    while True:
+        jobs = [_thumbnail_queue.get()]
+        while True:
+            try:
+                jobs.append(_thumbnail_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        batches = defaultdict(list)  # recording path -> [(timestamp, cache path)]
+        for recording_path, timestamp, thumbnail_path in jobs:
+            batches[recording_path].append((timestamp, thumbnail_path))
+        
+        for recording_path, targets in batches.items():
+            try:
+                if av is not None:
+                    try:
+                        render_thumbnails(recording_path, targets)
+                    except (av.error.FFmpegError, StopIteration, OSError) as e:
+                        # Whatever PyAV's bundled libraries can't decode may still work with the FFmpeg CLI
+                        logger.warning("PyAV could not thumbnail %s, falling back to FFmpeg: %s", recording_path, e)
+                        targets_left = [target for target in targets if not os.path.exists(target[1])]
+                        generate_thumbnail_sheet(recording_path, targets_left)
+                else:
+                    generate_thumbnail_sheet(recording_path, targets)
+            except Exception as e:
+                logger.error("Error generating thumbnails for %s: %s", recording_path, e)
+            finally:
+                ready = []
+                for timestamp, thumbnail_path in targets:
+                    # Whatever a failed encode left behind
+                    try:
+                        os.unlink(thumbnail_path + THUMBNAIL_TMP_SUFFIX)
+                    except FileNotFoundError:
+                        pass
+                    if os.path.exists(thumbnail_path):
+                        # Cache names are <thumbnail_key>_<ms>.<ext>, see thumbnail_cache_path
+                        ready.append((timestamp, os.path.basename(thumbnail_path).split("_", 1)[0]))
+                    else:
+                        # Recorded before waiters wake, so their retries already see it
+                        record_thumbnail_failure(thumbnail_path)
+                with _thumbnail_jobs_lock:
+                    for _, thumbnail_path in targets:
+                        _thumbnail_jobs.pop(thumbnail_path).set()
+            for timestamp, key in ready:
+                publish_thumbnail_ready(recording_path, timestamp, key)
+
+# Cache path -> image bytes, least recently served first
+_thumbnail_memory = OrderedDict()
+_thumbnail_memory_bytes = 0
+_thumbnail_memory_lock = Lock()
+
+def thumbnail_memory_get(thumbnail_path):
+    with _thumbnail_memory_lock:
+        blob = _thumbnail_memory.get(thumbnail_path)
+        if blob is not None:
+            _thumbnail_memory.move_to_end(thumbnail_path)
+        return blob
+
+def thumbnail_memory_put(thumbnail_path, blob):
+    """Keep a served thumbnail in RAM, evicting the least recently served beyond the budget"""
+    global _thumbnail_memory_bytes
+    if not blob:
+        return
+    with _thumbnail_memory_lock:
+        previous = _thumbnail_memory.pop(thumbnail_path, None)
+        if previous is not None:
+            _thumbnail_memory_bytes -= len(previous)
+        _thumbnail_memory[thumbnail_path] = blob
+        _thumbnail_memory_bytes += len(blob)
+        while _thumbnail_memory_bytes > THUMBNAIL_MEMORY_CACHE_BYTES:
+            _, evicted = _thumbnail_memory.popitem(last=False)
+            _thumbnail_memory_bytes -= len(evicted)
+
+def latest_recording(camera_id):
+    """Name of the camera's newest recording; the timestamp in the name sorts chronologically"""
+    prefix = f"camera_{camera_id}_"
+    with os.scandir(RECORDINGS_DIR) as entries:
+        names = [entry.name for entry in entries
+                 if entry.name.startswith(prefix) and entry.name.endswith(".mp4")]
+    return max(names, default=None)
+
+@functools.lru_cache(maxsize=256)
+def recording_duration(recording_path, key):
+    """Length of a recording in seconds, or None if it can't be read. key pins it to one version of the file."""
+    if av is not None:
+        try:
+            with av.open(recording_path) as container:
+                if container.duration is not None:
+                    return container.duration / av.time_base
+        except (av.error.FFmpegError, OSError):
+            pass
+    try:
+        result = subprocess.run(
+            [FFPROBE, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", recording_path],
+            capture_output=True,
+            text=True,
+            timeout=10
+        )
+        return float(result.stdout)
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+
+def thumbnail_timestamp(recording_path, key, timestamp):
+    """
+    Snap a requested timestamp to whole seconds within the recording, so clients
+    can't make a new thumbnail (and cache file) for every float they send
+    """
+    timestamp = max(0, round(timestamp))
+    duration = recording_duration(recording_path, key)
+    if duration is not None:
+        timestamp = min(timestamp, max(0, math.ceil(duration) - 1))
+    return float(timestamp)
+
+def precompute_thumbnails(camera_id):
+    """Queue the default thumbnails of the camera's just-finished recording, so its first view is a cache hit"""
+    try:
+        recording = latest_recording(camera_id)
+        if recording is None:
+            return
+        recording_path = recording_file_path(recording)
+        key = thumbnail_key(recording_path, os.stat(recording_path))
+    except OSError as e:
+        logger.warning("Could not queue thumbnails for camera %s: %s", camera_id, e)
+        return
+    timestamp = thumbnail_timestamp(recording_path, key, THUMBNAIL_TIMESTAMP)
+    for image_format in ("webp", "jpg"):
+        thumbnail_path = thumbnail_cache_path(key, timestamp, image_format)
+        if not os.path.exists(thumbnail_path):
+            request_thumbnail(recording_path, timestamp, thumbnail_path)
+
+def thumbnail_key(recording_path, st):
+    """Cache key of a recording's thumbnail; changes whenever the recording does"""
+    return hashlib.blake2b(f"{recording_path}:{st.st_mtime_ns}:{st.st_size}".encode(), digest_size=16).hexdigest()
+
+def thumbnail_cache_path(key, timestamp, image_format="jpg"):
+    return os.path.join(THUMBNAILS_DIR, f"{key}_{round(timestamp * 1000)}.{image_format}")
+
+def sweep_thumbnail_cache(max_bytes=THUMBNAIL_CACHE_MAX_BYTES):
+    """Delete the least recently used thumbnails until the cache fits in max_bytes"""
+    try:
+        with os.scandir(THUMBNAILS_DIR) as entries:
+            # Files still being written belong to a thumbnail worker, which removes them
+            thumbnails = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                          for entry in entries
+                          if entry.is_file() and not entry.name.endswith(THUMBNAIL_TMP_SUFFIX)]
+    except FileNotFoundError:
+        return
+    # Thumbnails served from RAM never get their mtime bumped, so count them as most recently used
+    with _thumbnail_memory_lock:
+        hot = set(_thumbnail_memory)
+    thumbnails.sort(key=lambda thumbnail: (thumbnail[2] in hot, thumbnail[0]))
+    total = sum(size for _, size, _ in thumbnails)
+    for _, size, path in thumbnails:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError as e:
+            logger.warning(f"Failed to remove thumbnail {path}: {e}")
+
+def thumbnail_sweeper():
+    """Keep the thumbnail cache within THUMBNAIL_CACHE_MAX_BYTES while the app runs"""
+    while True:
+        sweep_thumbnail_cache()
+        time.sleep(THUMBNAIL_SWEEP_INTERVAL)
+
 @app.route('/api/recordings/<recording>/thumbnail')
 def get_recording_thumbnail(recording):
-    """Generate and return a thumbnail for the recording"""
+    """
+    Generate and return a thumbnail for the recording, optionally at ?t=<seconds>
+    (rounded to whole seconds and clamped to the recording's length). Only URLs
+    with the current ?v=<thumbnail_key>, as listed by /api/recordings, are immutable.
+    With ?async=1 a missing thumbnail is answered at once with a 202 placeholder;
+    a thumbnail_ready event on /api/thumbnails/events says when to fetch it again.
+    """
+    timestamp = request.args.get('t', THUMBNAIL_TIMESTAMP, type=float)
+    if not math.isfinite(timestamp):
+        return jsonify({"error": "Invalid timestamp"}), 400
+    recording_path = recording_file_path(recording)
+    if recording_path is None:
+        return jsonify({"error": "Invalid filename"}), 400
     try:
-        recording_path = os.path.join(RECORDINGS_DIR, recording)
-        if not os.path.exists(recording_path):
-            return jsonify({"error": "Recording not found"}), 404
+        st = os.stat(recording_path)
+    except FileNotFoundError:
+        return jsonify({"error": "Recording not found"}), 404
 
-        # Generate thumbnail using FFmpeg
-        thumbnail_path = os.path.join(RECORDINGS_DIR, f"thumb_{recording}.jpg")
-        if not os.path.exists(thumbnail_path):
-            subprocess.run([
-                'ffmpeg', '-i', recording_path,
-                '-ss', '00:00:01',
-                '-vframes', '1',
-                '-vf', 'scale=300:-1',
-                thumbnail_path
-            ], check=True)
-
-        return send_file(thumbnail_path, mimetype='image/jpeg')
-    except Exception as e:
-        logger.error(f"Error generating thumbnail: {e}")
-        return jsonify({"error": "Failed to generate thumbnail"}), 500
+    key = thumbnail_key(recording_path, st)
+    timestamp = thumbnail_timestamp(recording_path, key, timestamp)
+    # WebP is about half the bytes of JPEG; only clients that list it get it, if this build can write it
+    accepts_webp = "image/webp" in request.headers.get("Accept", "")
+    image_format = "webp" if accepts_webp and webp_supported() else "jpg"
+    thumbnail_path = thumbnail_cache_path(key, timestamp, image_format)
+    # Hot thumbnails are answered from RAM without touching the disk cache;
+    # sweep_thumbnail_cache keeps the files of those it holds
+    blob = None if X_ACCEL_PREFIX else thumbnail_memory_get(thumbnail_path)
+    if blob is None:
+        try:
+            os.utime(thumbnail_path)  # Mark as recently used for sweep_thumbnail_cache
+        except FileNotFoundError:
+            # Not cached yet. Failures are logged by thumbnail_worker, which generates
+            # it together with any other pending thumbnails
+            if thumbnail_failed_recently(thumbnail_path):
+                return jsonify({"error": "Failed to generate thumbnail"}), 500
+            done = request_thumbnail(recording_path, timestamp, thumbnail_path)
+            if request.args.get('async') == '1':
+                return Response(THUMBNAIL_PLACEHOLDER, status=202, mimetype='image/svg+xml',
+                                headers={'Cache-Control': 'no-store'})
+            done.wait(THUMBNAIL_TIMEOUT)
+            if not os.path.exists(thumbnail_path):
+                return jsonify({"error": "Failed to generate thumbnail"}), 500
+
+    mimetype = 'image/webp' if image_format == "webp" else 'image/jpeg'
+    if X_ACCEL_PREFIX:
+        # nginx sends the file and answers conditional requests for it itself
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = quote(f"{X_ACCEL_PREFIX}/{thumbnail_path}")
+    else:
+        if blob is None:
+            with open(thumbnail_path, 'rb') as f:
+                blob = f.read()
+            # Cache files only ever appear whole (commit_thumbnail), so only an empty one is suspect
+            if not blob:
+                return jsonify({"error": "Failed to generate thumbnail"}), 500
+            thumbnail_memory_put(thumbnail_path, blob)
+        response = Response(blob, mimetype=mimetype)
+        # The cache name is derived from the recording, so it doubles as a stable ETag
+        response.set_etag(os.path.basename(thumbnail_path))
+        response.last_modified = st.st_mtime
+        response.make_conditional(request, accept_ranges=True, complete_length=len(blob))
+    response.cache_control.public = True
+    if request.args.get('v') == key:
+        # The URL names this exact version of the recording, so it never changes
+        response.cache_control.max_age = THUMBNAIL_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = THUMBNAIL_REVALIDATE_AGE
+    response.vary.add('Accept')
+    return response
+
+@app.route('/api/thumbnails/events')
+def thumbnail_events():
+    """Server-sent events stream of thumbnail_ready events, ended after THUMBNAIL_EVENTS_LIFETIME"""
+    subscriber = queue.Queue()
+    with _thumbnail_subscribers_lock:
+        if len(_thumbnail_subscribers) >= THUMBNAIL_EVENTS_MAX_SUBSCRIBERS:
+            return jsonify({"error": "Too many event subscribers"}), 503, {'Retry-After': '30'}
+        _thumbnail_subscribers.add(subscriber)
+
+    def unsubscribe():
+        with _thumbnail_subscribers_lock:
+            _thumbnail_subscribers.discard(subscriber)
+
+    def stream():
+        yield f"retry: {THUMBNAIL_EVENTS_RETRY}\n\n"
+        deadline = time.monotonic() + THUMBNAIL_EVENTS_LIFETIME
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                event = subscriber.get(timeout=min(THUMBNAIL_EVENTS_KEEPALIVE, remaining))
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: thumbnail_ready\ndata: {app.json.dumps(event)}\n\n"
+
+    response = Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    # Also runs when the client goes away before the stream has started
+    response.call_on_close(unsubscribe)
+    return response
 
 # Add error handler
 @app.errorhandler(404)
@@ -840,18 +1645,39 @@ def ensure_directories():
     """Ensure all required directories exist"""
     dirs = [
         "static/hls",
+        THUMBNAILS_DIR,
         "recordings",
         "logs"
     ]
     for d in dirs:
-        Path(d).mkdir(parents=True, exist_ok=True)
-        os.chmod(d, 0o755)
+        try:
+            mode = os.stat(d).st_mode & 0o777
+        except FileNotFoundError:
+            Path(d).mkdir(parents=True)
+            mode = None
+        # Only touch permissions that are actually wrong (always after mkdir, which applies the umask)
+        if mode != 0o755:
+            os.chmod(d, 0o755)
+
+def warmup_probes():
+    """Fill the encoder and decoder probe caches before the first start or thumbnail needs them"""
+    stream_encode_args()
+    low_latency_hls_args()
+    detect_hw_decoder()
+    webp_supported()
 
 # Call this when the app starts
 ensure_directories()
+threading.Thread(target=resource_sampler, daemon=True).start()
+threading.Thread(target=thumbnail_sweeper, daemon=True).start()
+for _ in range(THUMBNAIL_WORKERS):
+    threading.Thread(target=thumbnail_worker, daemon=True).start()
+threading.Thread(target=warmup_probes, daemon=True).start()
 
 if __name__ == '__main__':
+    # Development server; in production run gunicorn -c gunicorn.conf.py wsgi:application
     # Create static and recordings directories if they don't exist
     os.makedirs('static', exist_ok=True)
     os.makedirs(RECORDINGS_DIR, exist_ok=True)
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    # Thread per request, so a thumbnail or download never holds up status polls
+    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
@@ -0,0 +1,10 @@
+# cd up && gunicorn -c gunicorn.conf.py wsgi:application
+#
+# A single worker owns every FFmpeg process (more workers would each track their
+# own streams); its threads keep status, playlist and recording requests flowing
+# while a large download or a start-streams call is in progress.
+bind = "0.0.0.0:5000"
+workers = 1
+worker_class = "gthread"
+threads = 32
+timeout = 120
@@ -0,0 +1,2 @@
+"""WSGI entry point: gunicorn -c gunicorn.conf.py wsgi:application"""
+from app import app as application